@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 import os
+import sys
 from netCDF4 import Dataset as netcdf_dataset
 import numpy as np
 import numpy.ma as ma
@@ -18,6 +19,14 @@ import cartopy.feature as cfeature
 import matplotlib.ticker as mticker
 import cmocean
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'mesh_cache'))
+from mesh_cache import MeshCache
+from animation_functions import get_time_count, stream_batch_frames, \
+    get_pixel_cells, get_color_lut, frame_to_rgba, save_in_segments, \
+    get_mpas_variable_names, prepare_frame_cache, finish_frame_cache, \
+    stream_cached_frames, input_file_signatures
+
 def _add_land_lakes_coastline(ax):
     land_50m = cfeature.NaturalEarthFeature(
             'physical', 'land', '50m', edgecolor='face',
@@ -62,6 +71,22 @@ variable = 'maxmld'
 #variable = 'temperatureSumTendencyTerms' # derived variable
 #variable = 'temperatureTendency' # derived variable
 
+# Batch mode: animate all of these variables (at all dlevels for 3d
+# variables) in a single pass through infiles instead of only `variable`.
+# All the variables must be in infiles.
+batchVariables = None
+#batchVariables = ['temperatureSurfaceFluxTendency',
+#                  'temperatureShortWaveTendency',
+#                  'temperatureForcingTendency',
+#                  'temperatureHorizontalAdvectionTendency',
+#                  'temperatureVerticalAdvectionTendency',
+#                  'temperatureTotalAdvectionTendency',
+#                  'temperatureHorMixTendency',
+#                  'temperatureVertMixTendency',
+#                  'temperatureNonLocalTendency',
+#                  'temperatureSumTendencyTerms',
+#                  'temperatureTendency']
+
 figdir = './animations_xymaps'
 if not os.path.isdir(figdir):
     os.makedirs(figdir)
@@ -69,6 +94,15 @@ if not os.path.isdir(figdir):
 figsize = [16, 12]
 figdpi = 100
 
+# directory where the extracted (Time, nCells) frames of each variable and
+# level are cached, so animations can be re-styled (colormap, clevels,
+# titles) without re-reading infiles, or None for no cache
+frameCacheDirectory = '{}/frame_cache'.format(figdir)
+
+# number of processes, each rendering a contiguous segment of months of each
+# animation (the segments are joined with ffmpeg)
+nworkers = 1
+
 # z levels [m] (relevant for 3d variables)
 #dlevels = [50.0, 100.0, 250.0, 500.0, 3000.0]
 dlevels = [0.]
@@ -287,39 +321,38 @@ variables = [{'name': 'temperatureSurfaceFluxTendency',
               'plot_anomalies': False,
               'is3d': False}]
 
-# Identify dictionary for desired variable
-vardict = next(item for item in variables if item['name'] == variable)
-
-varname = vardict['name']
-mpasvarname = vardict['mpas']
-factor = vardict['factor']
-plot_anomalies = vardict['plot_anomalies']
-is3d = vardict['is3d']
-vartitle = vardict['title']
-varunits = vardict['units']
-clevels = vardict['clevels']
-colormap0 = vardict['colormap']
-underColor = colormap0(colorIndices0[0])
-overColor = colormap0(colorIndices0[-1])
-if len(clevels) + 1 == len(colorIndices0):
-    # we have 2 extra values for the under/over so make the colormap
-    # without these values
-    colorIndices = colorIndices0[1:-1]
-elif len(clevels) - 1 != len(colorIndices0):
-    # indices list must be either one element shorter
-    # or one element longer than colorbarLevels list
-    raise ValueError('length mismatch between indices and '
-                     'colorbarLevels')
-colormap = cols.ListedColormap(colormap0(colorIndices))
-colormap.set_under(underColor)
-colormap.set_over(overColor)
-cnorm = cols.BoundaryNorm(clevels, colormap.N)
+def make_colormap(vardict):
+    """
+    Returns the colormap and norm for the given variable dictionary
+    """
+    clevels = vardict['clevels']
+    colormap0 = vardict['colormap']
+    underColor = colormap0(colorIndices0[0])
+    overColor = colormap0(colorIndices0[-1])
+    if len(clevels) + 1 == len(colorIndices0):
+        # we have 2 extra values for the under/over so make the colormap
+        # without these values
+        colorIndices = colorIndices0[1:-1]
+    elif len(clevels) - 1 != len(colorIndices0):
+        # indices list must be either one element shorter
+        # or one element longer than colorbarLevels list
+        raise ValueError('length mismatch between indices and '
+                         'colorbarLevels')
+    colormap = cols.ListedColormap(colormap0(colorIndices))
+    colormap.set_under(underColor)
+    colormap.set_over(overColor)
+    cnorm = cols.BoundaryNorm(clevels, colormap.N)
+    return colormap, cnorm
+
+
+# Identify dictionaries for the desired variables
+if batchVariables is None:
+    batchVariables = [variable]
+vardicts = [next(item for item in variables if item['name'] == name)
+            for name in batchVariables]
 
 mesh = xr.open_dataset(meshfile)
-lat = mesh.latCell.values
-lon = mesh.lonCell.values
-lat = np.rad2deg(lat)
-lon = np.rad2deg(lon)
+meshCache = MeshCache(meshfile)
 z = mesh.refBottomDepth.values
 # Find model levels for each depth level
 zlevels = np.zeros(np.shape(dlevels), dtype=np.int)
@@ -328,97 +361,64 @@ for id in range(len(dlevels)):
     zlevels[id] = np.argmin(dz)
 print('Model levels = ', z[zlevels])
 
-ds = xr.open_mfdataset(infiles, combine='nested', concat_dim='Time')
-ntime = ds.dims['Time']
+# frames are read one file at a time as they are rendered
+ntime = get_time_count(infiles)
 
-if plot_anomalies:
-    figtitle0 = 'Anomaly'
-else:
-    figtitle0 = ''
-
-if is3d:
-    for iz in range(len(dlevels)):
-        figfile = '{}/{}{}_depth{:04d}_{}.mp4'.format(figdir, varname, figtitle0, int(dlevels[iz]), runname)
-        figtitle0 = '{} {} (z={:5.1f} m)'.format(vartitle, figtitle0, z[zlevels[iz]])
-
-        if varname=='temperatureTotalAdvectionTendency':
-            mpasvarname1 = 'timeMonthly_avg_activeTracerHorizontalAdvectionTendency_temperatureHorizontalAdvectionTendency'
-            mpasvarname2 = 'timeMonthly_avg_activeTracerVerticalAdvectionTendency_temperatureVerticalAdvectionTendency'
-            fld = np.add(ds[mpasvarname1][:, :, zlevels[iz]].values,
-                         ds[mpasvarname2][:, :, zlevels[iz]].values)
-        elif varname=='temperatureForcingTendency':
-            mpasvarname1 = 'timeMonthly_avg_activeTracerSurfaceFluxTendency_temperatureSurfaceFluxTendency'
-            mpasvarname2 = 'timeMonthly_avg_temperatureShortWaveTendency'
-            fld = np.add(ds[mpasvarname1][:, :, zlevels[iz]].values,
-                         ds[mpasvarname2][:, :, zlevels[iz]].values)
-        elif varname=='temperatureTendency':
-            temp = ds[mpasvarname][:, :, zlevels[iz]].values
-            #fld = np.nan*np.ones(np.shape(temp))
-            #fld[1:-1, :] = np.diff(temp, n=1, axis=0)
-            fld = np.diff(temp, n=1, axis=0, prepend=np.nan*np.ones([1, np.shape(temp)[1]]))/86400. # assumes daily values
-        elif varname=='temperatureSumTendencyTerms':
-            mpasvarname1 = 'timeMonthly_avg_activeTracerSurfaceFluxTendency_temperatureSurfaceFluxTendency'
-            mpasvarname2 = 'timeMonthly_avg_temperatureShortWaveTendency'
-            mpasvarname3 = 'timeMonthly_avg_activeTracerHorizontalAdvectionTendency_temperatureHorizontalAdvectionTendency'
-            mpasvarname4 = 'timeMonthly_avg_activeTracerVerticalAdvectionTendency_temperatureVerticalAdvectionTendency'
-            mpasvarname5 = 'timeMonthly_avg_activeTracerHorMixTendency_temperatureHorMixTendency'
-            mpasvarname6 = 'timeMonthly_avg_activeTracerVertMixTendency_temperatureVertMixTendency'
-            mpasvarname7 = 'timeMonthly_avg_activeTracerNonLocalTendency_temperatureNonLocalTendency'
-            fld = np.add(ds[mpasvarname1][:, :, zlevels[iz]].values,
-                         ds[mpasvarname2][:, :, zlevels[iz]].values)
-            fld = np.add(fld, ds[mpasvarname3][:, :, zlevels[iz]].values)
-            fld = np.add(fld, ds[mpasvarname4][:, :, zlevels[iz]].values)
-            fld = np.add(fld, ds[mpasvarname5][:, :, zlevels[iz]].values)
-            fld = np.add(fld, ds[mpasvarname6][:, :, zlevels[iz]].values)
-            fld = np.add(fld, ds[mpasvarname7][:, :, zlevels[iz]].values)
+# one animation for each 2d variable and each depth level of 3d variables
+animations = []
+figfiles = []
+for vardict in vardicts:
+    if vardict['plot_anomalies']:
+        anomalyTitle = 'Anomaly'
+    else:
+        anomalyTitle = ''
+    if vardict['is3d']:
+        for iz in range(len(dlevels)):
+            figfile = '{}/{}{}_depth{:04d}_{}.mp4'.format(figdir, vardict['name'], anomalyTitle, int(dlevels[iz]), runname)
+            figtitle0 = '{} {} (z={:5.1f} m)'.format(vardict['title'], anomalyTitle, z[zlevels[iz]])
+            animations.append((vardict, zlevels[iz], figtitle0))
+            figfiles.append(figfile)
+    else:
+        figfile = '{}/{}{}_{}.mp4'.format(figdir, vardict['name'], anomalyTitle, runname)
+        figtitle0 = '{} {}'.format(vardict['title'], anomalyTitle)
+        animations.append((vardict, None, figtitle0))
+        figfiles.append(figfile)
+
+# the fields to extract for each animation
+fields = [(vardict['name'], vardict['mpas'], zlevel, vardict['factor'],
+           vardict['plot_anomalies'])
+          for vardict, zlevel, _ in animations]
+
+if frameCacheDirectory is not None:
+    nCells = meshCache.lat_lon_cell_degrees()[0].size
+    cacheFiles = []
+    cacheMetadata = []
+    cacheComplete = []
+    for varname, mpasvarname, zlevel, _, _ in fields:
+        if zlevel is None:
+            cacheFile = '{}/{}_{}'.format(frameCacheDirectory, runname, varname)
         else:
-            fld = ds[mpasvarname][:, :, zlevels[iz]].values
-        fld = factor*fld
-        if plot_anomalies:
-            fld = fld - fld[0, :]
-        #print(varname, int(dlevels[iz]), np.min(fld), np.max(fld))
-
-        fig = plt.figure(figsize=figsize, dpi=figdpi)
-        ax = plt.axes(projection=ccrs.Miller(central_longitude=0))
-        _add_land_lakes_coastline(ax)
-        data_crs = ccrs.PlateCarree()
-        ax.set_extent([-180, 180, -90, 90], crs=data_crs)
-        gl = ax.gridlines(crs=data_crs, color='k', linestyle=':', zorder=5)
-        # This will work with cartopy 0.18:
-        #gl.xlocator = mticker.FixedLocator(np.arange(-180., 181., 40.))
-        #gl.ylocator = mticker.FixedLocator(np.arange(-80., 81., 20.))
-
-        ax.cla()
-        shading = ax.scatter(lon, lat, s=1.0, c=fld[0, :], cmap=colormap, norm=cnorm,
-                             marker='o', transform=data_crs)
-        cax, kw = mpl.colorbar.make_axes(ax, location='bottom', pad=0.03, shrink=0.9)
-        cbar = plt.colorbar(shading, cax=cax, ticks=clevels, **kw)
-        cbar.ax.tick_params(labelsize=14, labelcolor='black')
-        cbar.set_label(varunits, fontsize=14)
-        figtitle = '{} month={:d}'.format(figtitle0, 1)
-        ax.set_title(figtitle, y=1.04, fontsize=18)
-        #plt.savefig('tmp.png', bbox_inches='tight')
-
-        def animate(i):
-            ax.cla()
-            shading = ax.scatter(lon, lat, s=1.0, c=fld[i, :], cmap=colormap, norm=cnorm,
-                                 marker='o', transform=data_crs)
-            figtitle = '{} month={:d}'.format(figtitle0, i+1)
-            ax.set_title(figtitle, y=1.04, fontsize=16)
-
-        interval = 100 #in seconds     
-        #ani = animation.FuncAnimation(fig, animate, frames=range(5), interval=interval)
-        ani = animation.FuncAnimation(fig, animate, frames=range(ntime), interval=interval)
-        ani.save(figfile)
-else:
-    figfile = '{}/{}{}_{}.mp4'.format(figdir, varname, figtitle0, runname)
-    figtitle0 = '{} {}'.format(vartitle, figtitle0)
+            cacheFile = '{}/{}_{}_level{:03d}'.format(frameCacheDirectory, runname, varname, zlevel)
+        metadata = {'runname': runname,
+                    'variable': varname,
+                    'mpas': get_mpas_variable_names(varname, mpasvarname),
+                    'zlevel': None if zlevel is None else int(zlevel),
+                    'infiles': input_file_signatures(infiles)}
+        cacheFiles.append(cacheFile)
+        cacheMetadata.append(metadata)
+        cacheComplete.append(prepare_frame_cache(cacheFile, metadata,
+                                                 (ntime, nCells)))
+        if cacheComplete[-1]:
+            print('Reading {} from {}.npy'.format(varname, cacheFile))
+
 
-    fld = ds[mpasvarname].values
-    fld = factor*fld
-    if plot_anomalies:
-        fld = fld - fld[0, :]
-    #print(varname, np.min(fld), np.max(fld))
+def make_figure(vardict, figtitle0):
+    """
+    Make the figure for an animation of the given variable, returning the
+    figure and a function of the month index and field that draws a frame
+    """
+    colormap, cnorm = make_colormap(vardict)
+    lut = get_color_lut(colormap)
 
     fig = plt.figure(figsize=figsize, dpi=figdpi)
     ax = plt.axes(projection=ccrs.Miller(central_longitude=0))
@@ -430,25 +430,71 @@ else:
     #gl.xlocator = mticker.FixedLocator(np.arange(-180., 181., 40.))
     #gl.ylocator = mticker.FixedLocator(np.arange(-80., 81., 20.))
 
-    ax.cla()
-    shading = ax.scatter(lon, lat, s=1.0, c=fld[0, :], cmap=colormap, norm=cnorm,
-                         marker='o', transform=data_crs)
+    # Each frame is an image made by looking up the cell under each pixel,
+    # drawn below the land and coastlines, so cells are never re-projected
+    extent = ax.get_extent()
+    nx = figsize[0]*figdpi
+    ny = int(nx*(extent[3] - extent[2])/(extent[1] - extent[0]))
+    pixelCells = get_pixel_cells(meshCache, ax.projection, extent, nx, ny)
+
+    image = ax.imshow(np.zeros((ny, nx, 4), dtype=np.uint8),
+                      extent=extent, transform=ax.projection, origin='upper',
+                      interpolation='nearest', zorder=1)
     cax, kw = mpl.colorbar.make_axes(ax, location='bottom', pad=0.03, shrink=0.9)
-    cbar = plt.colorbar(shading, cax=cax, ticks=clevels, **kw)
+    cbar = plt.colorbar(cm.ScalarMappable(norm=cnorm, cmap=colormap), cax=cax,
+                        ticks=vardict['clevels'], **kw)
     cbar.ax.tick_params(labelsize=14, labelcolor='black')
-    cbar.set_label(varunits, fontsize=14)
-    figtitle = '{} month={:d}'.format(figtitle0, 1)
-    ax.set_title(figtitle, y=1.04, fontsize=18)
-    plt.savefig('tmp.png', bbox_inches='tight')
-
-    def animate(i):
-        ax.cla()
-        shading = ax.scatter(lon, lat, s=1.0, c=fld[i, :], cmap=colormap, norm=cnorm,
-                             marker='o', transform=data_crs)
+    cbar.set_label(vardict['units'], fontsize=14)
+
+    def draw_frame(i, fld):
+        image.set_data(frame_to_rgba(fld, pixelCells, lut, cnorm))
         figtitle = '{} month={:d}'.format(figtitle0, i+1)
-        ax.set_title(figtitle, y=1.04, fontsize=18)
+        ax.set_title(figtitle, y=1.04, fontsize=16)
+
+    return fig, draw_frame
+
+
+def render_frames(startFrame, endFrame, figfiles):
+    """
+    Render the months in [startFrame, endFrame) of all animations to
+    figfiles, reading each input file once
+    """
+    interval = 100 #in seconds
+    figures = []
+    writers = []
+    drawFrames = []
+    for (vardict, _, figtitle0), figfile in zip(animations, figfiles):
+        fig, draw_frame = make_figure(vardict, figtitle0)
+        writer = animation.FFMpegWriter(fps=1000./interval)
+        writer.setup(fig, figfile, dpi=figdpi)
+        figures.append(fig)
+        writers.append(writer)
+        drawFrames.append(draw_frame)
+
+    if frameCacheDirectory is None:
+        frameStream = stream_batch_frames(infiles, fields, startFrame,
+                                          endFrame)
+    else:
+        frameStream = stream_cached_frames(infiles, fields, cacheFiles,
+                                           cacheComplete, startFrame,
+                                           endFrame)
+    for i, frames in frameStream:
+        for draw_frame, writer, fld in zip(drawFrames, writers, frames):
+            draw_frame(i, fld)
+            writer.grab_frame()
+
+    for fig, writer in zip(figures, writers):
+        writer.finish()
+        plt.close(fig)
+
+
+if nworkers > 1:
+    save_in_segments(render_frames, ntime, figfiles, nworkers)
+else:
+    render_frames(0, ntime, figfiles)
 
-    interval = 100 #in seconds     
-    #ani = animation.FuncAnimation(fig, animate, frames=range(5), interval=interval)
-    ani = animation.FuncAnimation(fig, animate, frames=range(ntime), interval=interval)
-    ani.save(figfile)
+if frameCacheDirectory is not None:
+    for cacheFile, metadata, complete in zip(cacheFiles, cacheMetadata,
+                                             cacheComplete):
+        if not complete:
+            finish_frame_cache(cacheFile, metadata)
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 import os
+import sys
 from netCDF4 import Dataset as netcdf_dataset
 import numpy as np
 import numpy.ma as ma
@@ -17,9 +18,17 @@ import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import matplotlib.ticker as mticker
 import cmocean
-import time
 
-from mpas_analysis.ocean.utility import compute_zmid
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'mesh_cache'))
+from mesh_cache import MeshCache
+from animation_functions import get_pixel_cells, get_color_lut, \
+    frame_to_rgba, save_in_segments, get_time_count, read_chunks, \
+    get_mpas_variable_names, evaluate_field, derivedVariables, \
+    compute_layer_weights, update_layer_weights, average_layers, \
+    prepare_frame_cache, finish_frame_cache, open_frame_cache, \
+    input_file_signatures
+import time
 
 def _add_land_lakes_coastline(ax):
     land_50m = cfeature.NaturalEarthFeature(
@@ -70,6 +79,15 @@ if not os.path.isdir(figdir):
 figsize = [16, 12]
 figdpi = 100
 
+# directory where the extracted (Time, nCells) layer averages of each
+# variable are cached, so animations can be re-styled (colormap, clevels,
+# titles) without re-reading infiles, or None for no cache
+frameCacheDirectory = '{}/frame_cache'.format(figdir)
+
+# number of processes, each rendering a contiguous segment of months of the
+# animation (the segments are joined with ffmpeg)
+nworkers = 1
+
 # zmin,zmax over which to average
 #zmin = -200.
 #zmax = 0.
@@ -78,6 +96,20 @@ zmax = -200.
 #zmin = -6000.
 #zmax = -1000.
 
+# relative change in layerThickness from the thickness the averaging weights
+# of a column were computed from that triggers recomputing them (only layers
+# that set the column's overlap with [zmin, zmax] are checked), or None to
+# always use weights from the layer thickness in the mesh file
+thicknessTolerance = 0.01
+
+# number of threads for the vertical averaging
+nthreads = 1
+
+# this script uses monthly differences for the temperature tendency
+layerDerivedVariables = dict(derivedVariables)
+layerDerivedVariables['temperatureTendency'] = dict(
+    derivedVariables['temperatureTendency'], interval=30.4375*86400.) # assumes monthly values
+
 colorIndices0 = [0, 10, 28, 57, 85, 113, 142, 170, 198, 227, 242, 255]
 
 variables = [{'name': 'temperatureSurfaceFluxTendency',
@@ -240,24 +272,25 @@ cnorm = cols.BoundaryNorm(clevels, colormap.N)
 
 tic = time.perf_counter()
 
-mesh = xr.open_dataset(meshfile)
-lat = mesh.latCell.values
-lon = mesh.lonCell.values
-weights = np.cos(lat)
-lat = np.rad2deg(lat)
-lon = np.rad2deg(lon)
-zMid = compute_zmid(mesh.bottomDepth, mesh.maxLevelCell, mesh.layerThickness).squeeze()
-depthMask = np.logical_and(zMid >= zmin, zMid <= zmax)
-depthMask.compute()
-
-ds = xr.open_mfdataset(infiles, combine='nested', concat_dim='Time')
-ds['depthMask'] = depthMask
-layerThickness = ds.timeMonthly_avg_layerThickness.where(depthMask)
-layerThicknessSum = layerThickness.sum(dim='nVertLevels')
-ntime = ds.dims['Time']
+meshCache = MeshCache(meshfile)
+lat, lon = meshCache.lat_lon_cell_degrees()
+weights = np.cos(np.deg2rad(lat))
+bottomDepth = meshCache.read_variable('bottomDepth')
+maxLevelCell = meshCache.read_variable('maxLevelCell')
+
+# weights for averaging over [zmin, zmax], computed once per mesh from the
+# layer thickness in the mesh file (the reference z-star coordinate)
+refLayerThickness = meshCache.get(
+    'layerThickness', lambda: meshCache.read_variable('layerThickness'))
+refLayerWeights = meshCache.get(
+    'layerWeights_{:g}_{:g}'.format(zmin, zmax),
+    lambda: compute_layer_weights(refLayerThickness, bottomDepth,
+                                  maxLevelCell, zmin, zmax))
+
+ntime = get_time_count(infiles)
 
 toc = time.perf_counter()
-print('\nReading data done in {:0.4f} seconds'.format(toc-tic))
+print('\nReading mesh done in {:0.4f} seconds'.format(toc-tic))
 
 if plot_anomalies:
     figtitle0 = 'Anomaly'
@@ -272,38 +305,71 @@ figtitle0 = '{} {} (z={:d}-{:d} m)'.format(vartitle, figtitle0,
 
 tic = time.perf_counter()
 
-if varname=='temperatureTotalAdvectionTendency':
-    mpasvarname1 = 'timeMonthly_avg_activeTracerHorizontalAdvectionTendency_temperatureHorizontalAdvectionTendency'
-    mpasvarname2 = 'timeMonthly_avg_activeTracerVerticalAdvectionTendency_temperatureVerticalAdvectionTendency'
-    fld = ds[mpasvarname1] + ds[mpasvarname2]
-elif varname=='temperatureVertMixLocalNonlocalTendency':
-    mpasvarname1 = 'timeMonthly_avg_activeTracerVertMixTendency_temperatureVertMixTendency'
-    mpasvarname2 = 'timeMonthly_avg_activeTracerNonLocalTendency_temperatureNonLocalTendency'
-    fld = ds[mpasvarname1] + ds[mpasvarname2]
-elif varname=='temperatureForcingTendency':
-    mpasvarname1 = 'timeMonthly_avg_activeTracerSurfaceFluxTendency_temperatureSurfaceFluxTendency'
-    mpasvarname2 = 'timeMonthly_avg_temperatureShortWaveTendency'
-    fld = ds[mpasvarname1] + ds[mpasvarname2]
-elif varname=='temperatureTendency':
-    temp = ds[mpasvarname]
-    first = np.nan*xr.ones_like(temp.isel(Time=0))
-    first = first.expand_dims('Time')
-    fld = temp.diff(dim='Time')/(30.4375*86400.) # assumes monthly values
-    fld = xr.concat([first, fld], dim='Time')
-elif varname=='temperatureSumTendencyTerms':
-    mpasvarname1 = 'timeMonthly_avg_activeTracerSurfaceFluxTendency_temperatureSurfaceFluxTendency'
-    mpasvarname2 = 'timeMonthly_avg_temperatureShortWaveTendency'
-    mpasvarname3 = 'timeMonthly_avg_activeTracerHorizontalAdvectionTendency_temperatureHorizontalAdvectionTendency'
-    mpasvarname4 = 'timeMonthly_avg_activeTracerVerticalAdvectionTendency_temperatureVerticalAdvectionTendency'
-    mpasvarname5 = 'timeMonthly_avg_activeTracerHorMixTendency_temperatureHorMixTendency'
-    mpasvarname6 = 'timeMonthly_avg_activeTracerVertMixTendency_temperatureVertMixTendency'
-    mpasvarname7 = 'timeMonthly_avg_activeTracerNonLocalTendency_temperatureNonLocalTendency'
-    fld = ds[mpasvarname1] + ds[mpasvarname2] + ds[mpasvarname3] + ds[mpasvarname4] + \
-          ds[mpasvarname5] + ds[mpasvarname6] + ds[mpasvarname7]
+mpasVarNames = get_mpas_variable_names(varname, mpasvarname)
+if frameCacheDirectory is None:
+    cacheComplete = False
+else:
+    cacheFile = '{}/{}_{}_depths{:04d}-{:04d}'.format(
+        frameCacheDirectory, runname, varname, np.abs(np.int(zmax)),
+        np.abs(np.int(zmin)))
+    cacheMetadata = {'runname': runname,
+                     'variable': varname,
+                     'mpas': mpasVarNames,
+                     'zmin': zmin,
+                     'zmax': zmax,
+                     'thicknessTolerance': thicknessTolerance,
+                     'infiles': input_file_signatures(infiles)}
+    cacheComplete = prepare_frame_cache(cacheFile, cacheMetadata,
+                                        (ntime, len(lat)))
+
+if cacheComplete:
+    print('Reading {} from {}.npy'.format(varname, cacheFile))
+    fld = np.array(open_frame_cache(cacheFile), dtype=float)
 else:
-    fld = ds[mpasvarname]
-fld = (fld.where(depthMask)*layerThickness).sum(dim='nVertLevels') / layerThicknessSum
-fld = factor*fld.values
+    # read one file at a time, computing the (possibly derived) variable on
+    # all levels and averaging it over [zmin, zmax].  The weights of a column
+    # are recomputed from the monthly layer thickness only when the layers
+    # that set its overlap with [zmin, zmax] depart from the thickness they
+    # were computed from by more than thicknessTolerance.
+    levels = {mpasName: {None} for mpasName in mpasVarNames}
+    if thicknessTolerance is not None:
+        levels['timeMonthly_avg_layerThickness'] = {None}
+
+    layerWeights = np.array(refLayerWeights)
+    weightThickness = np.array(refLayerThickness)
+    rebuiltMonths = 0
+    rebuiltCells = 0
+    fld = np.zeros((ntime, len(lat)))
+    state = {}
+    month = 0
+    for chunk in read_chunks(infiles, levels):
+        fldChunk = evaluate_field(varname, mpasvarname, None, chunk, {}, state,
+                                  registry=layerDerivedVariables)
+        for i in range(fldChunk.shape[0]):
+            if thicknessTolerance is not None:
+                layerThickness = chunk[('timeMonthly_avg_layerThickness', None)][i]
+                ncells = update_layer_weights(
+                    layerWeights, weightThickness, layerThickness,
+                    bottomDepth, maxLevelCell, zmin, zmax, thicknessTolerance)
+                if ncells > 0:
+                    rebuiltMonths += 1
+                    rebuiltCells += ncells
+            fld[month, :] = average_layers(fldChunk[i:i+1], layerWeights,
+                                           threads=nthreads)[0, :]
+            month += 1
+    if thicknessTolerance is not None:
+        print('Layer weights rebuilt in {:d} of {:d} months ({:d} column '
+              'updates out of {:d} columns)'.format(
+                  rebuiltMonths, ntime, rebuiltCells, len(lat)))
+    if frameCacheDirectory is not None:
+        # the cache holds float32 values, so use them here as well
+        cache = open_frame_cache(cacheFile, mode='r+')
+        cache[:] = fld
+        cache.flush()
+        fld = np.array(cache, dtype=float)
+        del cache
+        finish_frame_cache(cacheFile, cacheMetadata)
+fld = factor*fld
 if plot_anomalies:
     fld = fld - fld[0, :]
 print(varname, np.nanmin(fld), np.nanmax(fld))
@@ -327,38 +393,61 @@ print('\nComputing mean,std done in {:0.4f} seconds'.format(toc-tic))
 
 tic = time.perf_counter()
 
-fig = plt.figure(figsize=figsize, dpi=figdpi)
-ax = plt.axes(projection=ccrs.Miller(central_longitude=0))
-_add_land_lakes_coastline(ax)
-data_crs = ccrs.PlateCarree()
-ax.set_extent([-180, 180, -90, 90], crs=data_crs)
-gl = ax.gridlines(crs=data_crs, color='k', linestyle=':', zorder=5)
-# This will work with cartopy 0.18:
-#gl.xlocator = mticker.FixedLocator(np.arange(-180., 181., 40.))
-#gl.ylocator = mticker.FixedLocator(np.arange(-80., 81., 20.))
-
-ax.cla()
-shading = ax.scatter(lon, lat, s=1.0, c=fld[0, :], cmap=colormap, norm=cnorm,
-                     marker='o', transform=data_crs)
-cax, kw = mpl.colorbar.make_axes(ax, location='bottom', pad=0.03, shrink=0.9)
-cbar = plt.colorbar(shading, cax=cax, ticks=clevels, **kw)
-cbar.ax.tick_params(labelsize=14, labelcolor='black')
-cbar.set_label(varunits, fontsize=14)
-figtitle = '{}, mean={:.2e}, std={:5.2f}, month=1'.format(figtitle0, mean[0], std[0])
-ax.set_title(figtitle, y=1.04, fontsize=18)
-#plt.savefig('tmp.png', bbox_inches='tight')
-
-def animate(i):
-    ax.cla()
-    shading = ax.scatter(lon, lat, s=1.0, c=fld[i, :], cmap=colormap, norm=cnorm,
-                         marker='o', transform=data_crs)
+lut = get_color_lut(colormap)
+
+
+def render_frames(startFrame, endFrame, figfile):
+    """
+    Render the months in [startFrame, endFrame) to figfile
+    """
+    fig = plt.figure(figsize=figsize, dpi=figdpi)
+    ax = plt.axes(projection=ccrs.Miller(central_longitude=0))
+    _add_land_lakes_coastline(ax)
+    data_crs = ccrs.PlateCarree()
+    ax.set_extent([-180, 180, -90, 90], crs=data_crs)
+    gl = ax.gridlines(crs=data_crs, color='k', linestyle=':', zorder=5)
+    # This will work with cartopy 0.18:
+    #gl.xlocator = mticker.FixedLocator(np.arange(-180., 181., 40.))
+    #gl.ylocator = mticker.FixedLocator(np.arange(-80., 81., 20.))
+
+    # Each frame is an image made by looking up the cell under each pixel,
+    # drawn below the land and coastlines, so cells are never re-projected
+    extent = ax.get_extent()
+    nx = figsize[0]*figdpi
+    ny = int(nx*(extent[3] - extent[2])/(extent[1] - extent[0]))
+    pixelCells = get_pixel_cells(meshCache, ax.projection, extent, nx, ny)
+
+    i = startFrame
+    image = ax.imshow(frame_to_rgba(fld[i, :], pixelCells, lut, cnorm),
+                      extent=extent, transform=ax.projection, origin='upper',
+                      interpolation='nearest', zorder=1)
+    cax, kw = mpl.colorbar.make_axes(ax, location='bottom', pad=0.03, shrink=0.9)
+    cbar = plt.colorbar(cm.ScalarMappable(norm=cnorm, cmap=colormap), cax=cax,
+                        ticks=clevels, **kw)
+    cbar.ax.tick_params(labelsize=14, labelcolor='black')
+    cbar.set_label(varunits, fontsize=14)
     figtitle = '{}, mean={:.2e}, std={:5.2f}, month={:d}'.format(figtitle0, mean[i], std[i], i+1)
-    ax.set_title(figtitle, y=1.04, fontsize=16)
+    ax.set_title(figtitle, y=1.04, fontsize=18)
+    #plt.savefig('tmp.png', bbox_inches='tight')
+
+    def animate(i):
+        image.set_data(frame_to_rgba(fld[i, :], pixelCells, lut, cnorm))
+        figtitle = '{}, mean={:.2e}, std={:5.2f}, month={:d}'.format(figtitle0, mean[i], std[i], i+1)
+        ax.set_title(figtitle, y=1.04, fontsize=16)
+
+    interval = 100 #in seconds
+    ani = animation.FuncAnimation(fig, animate,
+                                  frames=range(startFrame, endFrame),
+                                  interval=interval, repeat=False)
+    ani.save(figfile)
+    plt.close(fig)
 
-interval = 100 #in seconds     
-#ani = animation.FuncAnimation(fig, animate, frames=range(5), interval=interval)
-ani = animation.FuncAnimation(fig, animate, frames=range(ntime), interval=interval)
-ani.save(figfile)
+
+if nworkers > 1:
+    # workers are forked, so they share fld, mean and std with this process
+    save_in_segments(render_frames, ntime, figfile, nworkers)
+else:
+    render_frames(0, ntime, figfile)
 
 toc = time.perf_counter()
 print('\nAnimation done in {:0.4f} seconds'.format(toc-tic))
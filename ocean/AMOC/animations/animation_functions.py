@@ -0,0 +1,614 @@
+"""
+Functions shared by the xy-map animation scripts
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import os
+import json
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import matplotlib.pyplot as plt
+from netCDF4 import Dataset as netcdf_dataset
+from scipy.spatial import cKDTree
+import cartopy.crs as ccrs
+
+
+# Variables derived from MPAS variables (or other derived variables) listed
+# as their components.  A 'sum' adds two or more components and a
+# 'tendency' is the difference between consecutive months of its component
+# divided by 'interval' (in seconds).
+derivedVariables = {
+    'temperatureForcingTendency': {
+        'operation': 'sum',
+        'components': [
+            'timeMonthly_avg_activeTracerSurfaceFluxTendency_temperatureSurfaceFluxTendency',
+            'timeMonthly_avg_temperatureShortWaveTendency']},
+    'temperatureTotalAdvectionTendency': {
+        'operation': 'sum',
+        'components': [
+            'timeMonthly_avg_activeTracerHorizontalAdvectionTendency_temperatureHorizontalAdvectionTendency',
+            'timeMonthly_avg_activeTracerVerticalAdvectionTendency_temperatureVerticalAdvectionTendency']},
+    'temperatureVertMixLocalNonlocalTendency': {
+        'operation': 'sum',
+        'components': [
+            'timeMonthly_avg_activeTracerVertMixTendency_temperatureVertMixTendency',
+            'timeMonthly_avg_activeTracerNonLocalTendency_temperatureNonLocalTendency']},
+    'temperatureSumTendencyTerms': {
+        'operation': 'sum',
+        'components': [
+            'temperatureForcingTendency',
+            'temperatureTotalAdvectionTendency',
+            'timeMonthly_avg_activeTracerHorMixTendency_temperatureHorMixTendency',
+            'temperatureVertMixLocalNonlocalTendency']},
+    'temperatureTendency': {
+        'operation': 'tendency',
+        'components': ['timeMonthly_avg_activeTracers_temperature'],
+        'interval': 86400.}} # assumes daily values
+
+
+def get_time_counts(infiles):
+    """
+    Returns the number of Time records in each of the given files, read from
+    the file headers only
+    """
+    counts = []
+    for infile in infiles:
+        with netcdf_dataset(infile) as nc:
+            counts.append(len(nc.dimensions['Time']))
+    return counts
+
+
+def get_time_count(infiles):
+    """
+    Returns the total number of Time records in the given files
+    """
+    return sum(get_time_counts(infiles))
+
+
+def get_mpas_variable_names(varname, mpasvarname):
+    """
+    Returns the names of the MPAS variables needed to compute the given
+    (possibly derived) variable
+    """
+    if varname not in derivedVariables:
+        return [mpasvarname]
+    mpasVarNames = []
+    for component in derivedVariables[varname]['components']:
+        for mpasName in get_mpas_variable_names(component, component):
+            if mpasName not in mpasVarNames:
+                mpasVarNames.append(mpasName)
+    return mpasVarNames
+
+
+def evaluate_field(varname, mpasvarname, zlevel, chunk, results, state,
+                   registry=derivedVariables):
+    """
+    Returns the (nTime, nCells) field of a (possibly derived) variable at
+    the given level (or the whole variable if zlevel is None) for a chunk
+    from ``read_chunks()``
+
+    Sums are accumulated in place in a single new array.  ``results`` holds
+    the variables already evaluated for this chunk, so components shared
+    between derived variables are evaluated once, and ``state`` holds the
+    last month of the component of each tendency between chunks.  The
+    returned array may be shared, so it must not be modified.  A registry
+    other than ``derivedVariables`` may be given, e.g. to change the
+    interval of a tendency.
+    """
+    key = (varname, zlevel)
+    if key in results:
+        return results[key]
+
+    if varname not in registry:
+        fld = chunk[(mpasvarname, zlevel)]
+    else:
+        derived = registry[varname]
+        components = [evaluate_field(component, component, zlevel, chunk,
+                                     results, state, registry)
+                      for component in derived['components']]
+        if derived['operation'] == 'sum':
+            fld = np.add(components[0], components[1])
+            for component in components[2:]:
+                np.add(fld, component, out=fld)
+        elif derived['operation'] == 'tendency':
+            component = components[0]
+            previous = state.get(key)
+            if previous is None:
+                previous = np.nan*np.ones_like(component[0:1])
+            fld = np.diff(component, n=1, axis=0, prepend=previous)
+            fld /= derived['interval']
+            state[key] = component[-1:, :].copy()
+        else:
+            raise ValueError('Unknown operation {} for derived variable '
+                             '{}'.format(derived['operation'], varname))
+
+    results[key] = fld
+    return fld
+
+
+def read_chunks(infiles, levels):
+    """
+    A generator that reads the given MPAS variables one file at a time
+
+    ``levels`` is a dictionary from the name of each MPAS variable to read
+    to the vertical levels needed (``None`` for the whole variable, e.g. a
+    variable without nVertLevels).  For each file, yields a dictionary from
+    pairs of MPAS variable name and level to (nTime, nCells) arrays (or the
+    whole variable) with fill values replaced by NaN.  All the levels of a
+    variable are read together.
+    """
+    for infile in infiles:
+        with netcdf_dataset(infile) as nc:
+            chunk = {}
+            for mpasName, zlevels in levels.items():
+                var = nc.variables[mpasName]
+                if None in zlevels:
+                    chunk[(mpasName, None)] = _filled(var[:])
+                zlevels = sorted(zlevel for zlevel in zlevels
+                                 if zlevel is not None)
+                if len(zlevels) > 0:
+                    data = _filled(var[:, :, zlevels])
+                    for index, zlevel in enumerate(zlevels):
+                        chunk[(mpasName, zlevel)] = data[:, :, index]
+        yield chunk
+
+
+def stream_frames(infiles, varname, mpasvarname, zlevel=None, factor=1.,
+                  anomalies=False, startFrame=0, endFrame=None):
+    """
+    A generator over the frames of an animation, yielding the month index
+    and the (nCells,) field for that month
+
+    Only one file (typically one month) of the MPAS variables needed for
+    varname is held in memory at a time, along with the first frame if
+    anomalies are requested and the last month of temperature for
+    temperatureTendency.  If startFrame and endFrame are given, only the
+    frames in that range are produced and files before the one holding the
+    month preceding startFrame are not read.
+    """
+    fields = [(varname, mpasvarname, zlevel, factor, anomalies)]
+    for month, frames in stream_batch_frames(infiles, fields, startFrame,
+                                             endFrame):
+        yield month, frames[0]
+
+
+def stream_batch_frames(infiles, fields, startFrame=0, endFrame=None):
+    """
+    A generator over the frames of several animations at once, reading
+    each file only once
+
+    Parameters
+    ----------
+    infiles : list of str
+        The monthly files to read
+
+    fields : list of tuple
+        The varname, mpasvarname, zlevel (``None`` for 2D variables),
+        factor and whether to plot anomalies for each animation
+
+    startFrame, endFrame : int, optional
+        The range of months to produce, all by default
+
+    Yields
+    ------
+    month : int
+        The month index
+
+    frames : list of numpy.ndarray
+        The (nCells,) field for each animation
+    """
+    counts = get_time_counts(infiles)
+    offsets = np.cumsum([0] + counts)
+    if endFrame is None:
+        endFrame = offsets[-1]
+
+    first = [None]*len(fields)
+    if startFrame > 0 and any(field[4] for field in fields):
+        _, chunks = next(_compute_chunks(infiles[0:1], fields))
+        first = [chunk[0, :] for chunk in chunks]
+
+    # the file holding the month before startFrame (for tendencies)
+    firstFile = np.searchsorted(offsets, max(startFrame - 1, 0),
+                                side='right') - 1
+    for month, chunks in _compute_chunks(infiles[firstFile:], fields,
+                                         firstMonth=offsets[firstFile]):
+        for index, field in enumerate(fields):
+            if field[4]:
+                if first[index] is None:
+                    first[index] = chunks[index][0, :].copy()
+                chunks[index] -= first[index]
+        for i in range(chunks[0].shape[0]):
+            if month + i >= endFrame:
+                return
+            if month + i >= startFrame:
+                yield month + i, [chunk[i, :] for chunk in chunks]
+
+
+def input_file_signatures(infiles):
+    """
+    Returns the base name, size and modification time (in ns) of each input
+    file, for frame cache metadata, so frames are not reused once the files
+    are regenerated under the same names
+    """
+    signatures = []
+    for infile in infiles:
+        fileStat = os.stat(infile)
+        signatures.append([os.path.basename(infile), fileStat.st_size,
+                           fileStat.st_mtime_ns])
+    return signatures
+
+
+def prepare_frame_cache(cacheFile, metadata, shape):
+    """
+    Returns ``True`` if ``cacheFile`` holds a complete frame cache with the
+    given metadata
+
+    Otherwise, creates an uninitialized float32 array of the given shape,
+    typically (nTime, nCells), in ``cacheFile + '.npy'`` to be filled (e.g.
+    by ``stream_cached_frames()``, possibly in several processes) and
+    returns ``False``.  Call ``finish_frame_cache()`` once it is filled.
+    """
+    metadataFileName = '{}.json'.format(cacheFile)
+    if os.path.exists(metadataFileName):
+        with open(metadataFileName) as metadataFile:
+            if json.load(metadataFile) == metadata:
+                return True
+        os.remove(metadataFileName)
+
+    directory = os.path.dirname(cacheFile)
+    if directory != '' and not os.path.isdir(directory):
+        os.makedirs(directory)
+    cache = np.lib.format.open_memmap('{}.npy'.format(cacheFile), mode='w+',
+                                      dtype=np.float32, shape=tuple(shape))
+    del cache
+    return False
+
+
+def finish_frame_cache(cacheFile, metadata):
+    """
+    Marks a frame cache filled after ``prepare_frame_cache()`` as complete
+    by writing its metadata
+    """
+    metadataFileName = '{}.json'.format(cacheFile)
+    tempFileName = '{}.tmp{}'.format(metadataFileName, os.getpid())
+    with open(tempFileName, 'w') as metadataFile:
+        json.dump(metadata, metadataFile, indent=2)
+    os.replace(tempFileName, metadataFileName)
+
+
+def open_frame_cache(cacheFile, mode='r'):
+    """
+    Returns the frames in a frame cache as a memory map
+    """
+    return np.load('{}.npy'.format(cacheFile), mmap_mode=mode)
+
+
+def stream_cached_frames(infiles, fields, cacheFiles, complete, startFrame=0,
+                         endFrame=None):
+    """
+    Like ``stream_batch_frames()`` but with frames of each field read from
+    its frame cache if it is complete
+
+    Fields with incomplete caches (from ``prepare_frame_cache()``) are read
+    from infiles, and their frames are written to their caches (before the
+    factor and anomalies are applied) as they are produced.  If all caches
+    are complete, infiles are not read at all.  Frames are float32 values
+    from the caches in either case, so renderings do not depend on whether
+    the cache was complete.
+
+    Parameters
+    ----------
+    infiles : list of str
+        The monthly files to read
+
+    fields : list of tuple
+        The varname, mpasvarname, zlevel, factor and whether to plot
+        anomalies for each animation
+
+    cacheFiles : list of str
+        The frame cache of each field
+
+    complete : list of bool
+        Whether the cache of each field is complete
+
+    startFrame, endFrame : int, optional
+        The range of months to produce, all by default
+    """
+    if endFrame is None:
+        endFrame = get_time_count(infiles)
+
+    missing = [index for index in range(len(fields)) if not complete[index]]
+    caches = [open_frame_cache(cacheFile, mode='r' if done else 'r+')
+              for cacheFile, done in zip(cacheFiles, complete)]
+
+    if len(missing) > 0:
+        rawFields = [fields[index][0:3] + (1., False) for index in missing]
+        rawFrames = stream_batch_frames(infiles, rawFields, startFrame,
+                                        endFrame)
+
+    first = [None]*len(fields)
+    for index, field in enumerate(fields):
+        if field[4] and (complete[index] or startFrame > 0):
+            if not complete[index]:
+                _, frames = next(stream_batch_frames(infiles, [field[0:3] +
+                                                     (1., False)], 0, 1))
+                caches[index][0, :] = frames[0]
+            first[index] = np.array(caches[index][0, :])
+
+    for month in range(startFrame, endFrame):
+        if len(missing) > 0:
+            _, rawFrame = next(rawFrames)
+            for index, values in zip(missing, rawFrame):
+                caches[index][month, :] = values
+
+        frames = []
+        for index, (_, _, _, factor, anomalies) in enumerate(fields):
+            values = np.array(caches[index][month, :], dtype=float)
+            if anomalies:
+                if first[index] is None:
+                    first[index] = values.copy()
+                values -= first[index]
+            frames.append(factor*values)
+        yield month, frames
+
+    for index in missing:
+        caches[index].flush()
+
+
+def save_in_segments(render_segment, ntime, figfiles, workers):
+    """
+    Render one or more animations as contiguous segments of frames in
+    parallel and join the segments without re-encoding
+
+    Parameters
+    ----------
+    render_segment : function
+        A function with arguments startFrame, endFrame and the file name(s)
+        of the segment(s) that renders the frames in [startFrame, endFrame).
+        It is called in worker processes forked from this one.
+
+    ntime : int
+        The total number of frames
+
+    figfiles : str or list of str
+        The animation file(s) to write.  If a list, render_segment is passed
+        a list of segment files in the same order.
+
+    workers : int
+        The number of segments and worker processes
+    """
+    if isinstance(figfiles, list):
+        figfileList = figfiles
+    else:
+        figfileList = [figfiles]
+    bounds = np.linspace(0, ntime, workers + 1).astype(int)
+    segments = []
+    for index in range(workers):
+        if bounds[index + 1] > bounds[index]:
+            segmentFiles = []
+            for figfile in figfileList:
+                root, ext = os.path.splitext(figfile)
+                segmentFiles.append('{}.segment{:03d}{}'.format(root, index,
+                                                                ext))
+            if not isinstance(figfiles, list):
+                segmentFiles = segmentFiles[0]
+            segments.append((bounds[index], bounds[index + 1], segmentFiles))
+
+    with multiprocessing.get_context('fork').Pool(
+            len(segments), initializer=plt.switch_backend,
+            initargs=('Agg',)) as pool:
+        pool.starmap(render_segment, segments, chunksize=1)
+
+    for fileIndex, figfile in enumerate(figfileList):
+        if isinstance(figfiles, list):
+            segmentFiles = [segment[2][fileIndex] for segment in segments]
+        else:
+            segmentFiles = [segment[2] for segment in segments]
+        root, _ = os.path.splitext(figfile)
+        listFileName = '{}.segments.txt'.format(root)
+        with open(listFileName, 'w') as listFile:
+            for segmentFile in segmentFiles:
+                listFile.write("file '{}'\n".format(
+                    os.path.abspath(segmentFile)))
+        subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-f',
+                               'concat', '-safe', '0', '-i', listFileName,
+                               '-c', 'copy', figfile])
+        os.remove(listFileName)
+        for segmentFile in segmentFiles:
+            os.remove(segmentFile)
+
+
+def _compute_chunks(infiles, fields, firstMonth=0):
+    """
+    A generator yielding the index of the first month and a list with the
+    (nTime, nCells) field of each of the given fields for each file
+    """
+    levels = {}
+    for varname, mpasvarname, zlevel, _, _ in fields:
+        for mpasName in get_mpas_variable_names(varname, mpasvarname):
+            levels.setdefault(mpasName, set()).add(zlevel)
+
+    state = {}
+    month = firstMonth
+    for chunk in read_chunks(infiles, levels):
+        results = {}
+        chunks = [factor*evaluate_field(varname, mpasvarname, zlevel, chunk,
+                                        results, state)
+                  for varname, mpasvarname, zlevel, factor, _ in fields]
+        yield month, chunks
+        month += chunks[0].shape[0]
+
+
+def _filled(data):
+    """Returns a float array with masked values replaced by NaN"""
+    return np.ma.filled(np.ma.asarray(data, dtype=float), np.nan)
+
+
+def compute_layer_weights(layerThickness, bottomDepth, maxLevelCell, zmin,
+                          zmax):
+    """
+    Returns (nCells, nVertLevels) weights for averaging over [zmin, zmax]
+
+    The weight of each layer is the thickness of its overlap with
+    [zmin, zmax], with layer interfaces found by stacking the layer
+    thicknesses up from the sea floor, divided by the total overlap in the
+    column.  Weights are NaN in columns that do not overlap [zmin, zmax], so
+    their averages are NaN.
+    """
+    nVertLevels = layerThickness.shape[1]
+    valid = np.arange(nVertLevels)[np.newaxis, :] < \
+        maxLevelCell[:, np.newaxis]
+    h = np.where(valid, layerThickness, 0.)
+    # the bottom of each layer is the sea floor plus the thickness of the
+    # layers below it
+    zBot = -bottomDepth[:, np.newaxis] + \
+        np.cumsum(h[:, ::-1], axis=1)[:, ::-1] - h
+    zTop = zBot + h
+    overlap = np.maximum(np.minimum(zTop, zmax) - np.maximum(zBot, zmin), 0.)
+    overlap[np.logical_not(valid)] = 0.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = overlap/np.sum(overlap, axis=1)[:, np.newaxis]
+    return weights
+
+
+def update_layer_weights(layerWeights, weightThickness, layerThickness,
+                         bottomDepth, maxLevelCell, zmin, zmax, tolerance):
+    """
+    Recomputes, in place, the averaging weights of the columns whose layer
+    thickness has departed from the thickness their weights were computed
+    from (also updated in place) by more than the relative tolerance
+
+    Layer interfaces are stacked up from the sea floor, so only the layers
+    from the shallowest one overlapping [zmin, zmax] down to the sea floor
+    affect the weights of a column; changes in the layers above (e.g. the
+    top layer following the sea surface height) do not cause a rebuild.
+    Columns that do not overlap [zmin, zmax] are only recomputed once their
+    layers reach into it.
+
+    Returns the number of columns whose weights were recomputed.
+    """
+    nVertLevels = layerThickness.shape[1]
+    valid = np.arange(nVertLevels)[np.newaxis, :] < \
+        maxLevelCell[:, np.newaxis]
+    overlapping = layerWeights > 0.
+    relevant = np.logical_and(np.maximum.accumulate(overlapping, axis=1),
+                              valid)
+
+    changed = np.any(np.logical_and(
+        relevant, np.abs(layerThickness - weightThickness) >
+        tolerance*weightThickness), axis=1)
+
+    noOverlap = np.logical_not(overlapping.any(axis=1))
+    columnTop = -bottomDepth + np.sum(np.where(valid, layerThickness, 0.),
+                                      axis=1)
+    changed |= np.logical_and.reduce((noOverlap, -bottomDepth < zmax,
+                                      columnTop > zmin))
+    cells = np.flatnonzero(changed)
+    if len(cells) > 0:
+        layerWeights[cells, :] = compute_layer_weights(
+            layerThickness[cells, :], bottomDepth[cells], maxLevelCell[cells],
+            zmin, zmax)
+        weightThickness[cells, :] = layerThickness[cells, :]
+    return len(cells)
+
+
+def average_layers(fld, weights, threads=1):
+    """
+    Returns the (nTime, nCells) vertical average of an (nTime, nCells,
+    nVertLevels) field with weights from ``compute_layer_weights()``
+
+    NaNs in fld (e.g. below the sea floor) are replaced by zeros in place.
+    The multiply-reduce over nVertLevels is split into blocks of cells over
+    threads if threads > 1.
+    """
+    np.nan_to_num(fld, copy=False)
+    nCells = fld.shape[1]
+    average = np.empty(fld.shape[0:2])
+
+    def kernel(start, end):
+        average[:, start:end] = np.einsum('tck,ck->tc', fld[:, start:end, :],
+                                          weights[start:end, :])
+
+    if threads > 1:
+        bounds = np.linspace(0, nCells, threads + 1).astype(int)
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(kernel, bounds[0:-1], bounds[1:]))
+    else:
+        kernel(0, nCells)
+    return average
+
+
+def get_pixel_cells(meshCache, projection, extent, nx, ny):
+    """
+    Returns an (ny, nx) array with the index of the cell nearest to the
+    center of each pixel of an image (with origin='upper') covering
+    ``extent`` in ``projection`` coordinates
+
+    Pixels outside the projection or farther from any cell center than the
+    largest distance between neighboring cell centers are set to -1.  The
+    index is stored in the mesh cache, so it is only computed once per mesh,
+    projection and image size.
+    """
+    name = 'pixelCells_{}_{}x{}_{}'.format(
+        type(projection).__name__, nx, ny,
+        '_'.join(['{:.0f}'.format(value) for value in extent]))
+
+    def compute():
+        lat, lon = meshCache.lat_lon_cell_degrees()
+        cellPoints = _lon_lat_to_unit_vector(lon, lat)
+        tree = cKDTree(cellPoints)
+        distance, _ = tree.query(cellPoints, k=2)
+        maxDistance = distance[:, 1].max()
+
+        x0, x1, y0, y1 = extent
+        x = x0 + (x1 - x0)*(np.arange(nx) + 0.5)/nx
+        y = y1 - (y1 - y0)*(np.arange(ny) + 0.5)/ny
+        x, y = np.meshgrid(x, y)
+        lonLat = ccrs.Geodetic().transform_points(projection, x.ravel(),
+                                                  y.ravel())
+        pixelPoints = _lon_lat_to_unit_vector(lonLat[:, 0], lonLat[:, 1])
+        valid = np.all(np.isfinite(pixelPoints), axis=1)
+
+        pixelCells = -np.ones(nx*ny, dtype=np.int32)
+        distance, cells = tree.query(pixelPoints[valid],
+                                     distance_upper_bound=maxDistance)
+        pixelCells[valid] = np.where(np.isfinite(distance), cells, -1)
+        return pixelCells.reshape(ny, nx)
+
+    return meshCache.get(name, compute)
+
+
+def get_color_lut(colormap):
+    """
+    Returns a lookup table of RGBA colors (as bytes) indexed by the color
+    index from a BoundaryNorm plus one: the under color, the colormap colors
+    and the over color, followed by a transparent color for missing values
+    """
+    lut = colormap(np.arange(-1, colormap.N + 1), bytes=True)
+    return np.concatenate([lut, np.zeros((1, 4), dtype=np.uint8)])
+
+
+def frame_to_rgba(fld, pixelCells, lut, cnorm):
+    """
+    Returns an RGBA image of the field on cells, using the cell index of
+    each pixel from ``get_pixel_cells()`` and a lookup table from
+    ``get_color_lut()``
+    """
+    transparent = lut.shape[0] - 1
+    colorIndex = np.ma.filled(cnorm(fld), 0) + 1
+    colorIndex[np.isnan(fld)] = transparent
+    # pixels without a cell have index -1, so they get the appended last
+    # entry
+    colorIndex = np.append(colorIndex, transparent)
+    return lut[colorIndex[pixelCells]]
+
+
+def _lon_lat_to_unit_vector(lon, lat):
+    """Returns points on the unit sphere for lon and lat in degrees"""
+    lon = np.deg2rad(lon)
+    lat = np.deg2rad(lat)
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon),
+                     np.sin(lat)], axis=-1)
@@ -2,6 +2,9 @@ from __future__ import absolute_import, division, print_function, \
     unicode_literals
 
 import os
+import sys
+import argparse
+import multiprocessing
 import xarray
 import pandas as pd
 import numpy as np
@@ -19,7 +22,23 @@ from mpas_analysis.shared.io.utility import get_files_year_month, decode_strings
 
 from geometric_features import FeatureCollection, read_feature_collection
 
-from common_functions import hovmoeller_plot, add_inset
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'mesh_cache'))
+from mesh_cache import MeshCache
+
+from common_functions import hovmoeller_plot, add_inset, \
+    compute_region_weights, compute_regional_sums, \
+    append_to_time_series_store, get_time_series_store_years, \
+    open_time_series_store, compute_moving_average_anomalies
+
+parser = argparse.ArgumentParser(
+    description='Compute and plot regional OHC, temperature and salinity '
+                'anomalies as a function of time and depth')
+parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                    help='Number of processes used to compute yearly time '
+                         'series (each holds one year of 3D monthly fields '
+                         'in memory) and to render figures in parallel')
+args = parser.parse_args()
 
 meshName = 'EC30to60E2r2'
 restartFile = '/compyfs/inputdata/ocn/mpas-o/{}/ocean.EC30to60E2r2.200908.nc'.format(meshName)
@@ -48,12 +67,11 @@ if 'landIceMask' in dsRestart:
     openOceanMask = dsRestart.landIceMask == 0
 else:
     openOceanMask = None
-refBottomDepth = dsRestart.refBottomDepth
-maxLevelCell = dsRestart.maxLevelCell
+refBottomDepth = dsRestart.refBottomDepth.load()
 nVertLevels = dsRestart.sizes['nVertLevels']
-vertIndex = xarray.DataArray.from_dict(
-    {'dims': ('nVertLevels',), 'data': np.arange(nVertLevels)})
-depthMask = (vertIndex < maxLevelCell).transpose('nCells', 'nVertLevels')
+meshCache = MeshCache(restartFile)
+depthMask = xarray.DataArray(meshCache.depth_mask(),
+                             dims=('nCells', 'nVertLevels'))
 
 if os.path.exists(regionMaskFile):
     dsRegionMask = xarray.open_dataset(regionMaskFile)
@@ -63,6 +81,14 @@ if os.path.exists(regionMaskFile):
 else:
     raise IOError('No regional mask file found')
 
+# Sparse (nRegions x nCells) matrix of cell areas within each region (the last
+# row is Global), so each regional sum is a single matrix product
+regionWeights = compute_region_weights(dsRegionMask, areaCell, openOceanMask)
+totalArea = np.asarray(regionWeights.sum(axis=1)).ravel()
+for regionName, regionArea in zip(regionNames, totalArea):
+    print('  region: {}, totalArea: {} mil. km^2'.format(
+        regionName, 1e-12*regionArea))
+
 startYear = 1
 endYear = 200
 calendar = 'gregorian'
@@ -100,135 +126,162 @@ variableList = [var['mpas'] for var in variables] + \
     ['timeMonthly_avg_layerThickness']
 
 timeSeriesFile0 = '{}/OHC_T_S_trends_vsdepth'.format(outdir)
+timeSeriesStoreFile = '{}.nc'.format(timeSeriesFile0)
 
-# Compute regional averages one year at a time
-for year in years:
 
+def compute_year_time_series(year):
+    """
+    Compute regional time series for all variables for the given year and
+    write them to a temporary file that is renamed once complete, so a file
+    left behind by a killed process is never mistaken for a finished year
+    """
     timeSeriesFile = '{}_year{:04d}.nc'.format(timeSeriesFile0, year)
-
-    if not os.path.exists(timeSeriesFile):
-        print('\nComputing regional time series for year={}'.format(year))
-
-        datasets = []
-        for month in range(1, 13):
-            inputFile = '{}/{}.mpaso.hist.am.timeSeriesStatsMonthly.{:04d}-{:02d}-01.nc'.format(
-                modeldir, runName, year, month)
-            if not os.path.exists(inputFile):
-                raise IOError('Input file: {} not found'.format(inputFile))
-
-            dsTimeSlice = open_mpas_dataset(fileName=inputFile,
-                                            calendar=calendar,
-                                            variableList=variableList,
-                                            startDate=startDate,
-                                            endDate=endDate)
-            datasets.append(dsTimeSlice)
-        # combine data sets into a single data set
-        dsIn = xarray.concat(datasets, 'Time')
-
-        # Global depth-masked layer thickness and layer volume
-        layerThickness = dsIn.timeMonthly_avg_layerThickness
-        layerThickness = layerThickness.where(depthMask, drop=False)
-        layerVol = areaCell*layerThickness
-
-        datasets = []
-        regionIndices = []
-        for regionName in regionNames:
-            print('    region: {}'.format(regionName))
-
-            # Compute region total area and, for regionName
-            # other than Global, compute regional mask and
-            # regionally masked layer volume
-            if regionName=='Global':
-                regionIndices.append(nRegions-1)
-
-                totalArea = areaCell.sum()
-                if year==years[0]:
-                    print('      totalArea: {} mil. km^2'.format(1e-12*totalArea.values))
-            else:
-                regionIndex = regionNames.index(regionName)
-                regionIndices.append(regionIndex)
-
-                dsMask = dsRegionMask.isel(nRegions=regionIndex)
-                cellMask = dsMask.regionCellMasks == 1
-                if openOceanMask is not None:
-                    cellMask = np.logical_and(cellMask, openOceanMask)
-
-                localArea = areaCell.where(cellMask, drop=True)
-                totalArea = localArea.sum()
-                if year==years[0]:
-                    print('      totalArea: {} mil. km^2'.format(1e-12*totalArea.values))
-                localLayerVol = layerVol.where(cellMask, drop=True)
-
-            # Temporary dsOut (xarray dataset) containing results for
-            # all variables for one single region
-            dsOut = xarray.Dataset()
-            # Compute layer-volume weighted averages (or sums for OHC)
-            for var in variables:
-                outName = var['name']
-                mpasVarName = var['mpas']
-                units = var['units']
-                factor = var['fac']
-                description = var['title']
-
-                timeSeries = dsIn[mpasVarName]
-                timeSeries = timeSeries.where(depthMask, drop=False)
-                if regionName=='Global':
-                    timeSeries = (layerVol*timeSeries).sum(dim='nCells')
-                    if outName!='ohc':
-                        timeSeries = timeSeries / layerVol.sum(dim='nCells')
-                else:
-                    timeSeries = timeSeries.where(cellMask, drop=True)
-                    timeSeries = (localLayerVol*timeSeries).sum(dim='nCells')
-                    if outName!='ohc':
-                        timeSeries = timeSeries / localLayerVol.sum(dim='nCells')
-
-                dsOut[outName] = factor*timeSeries
-                dsOut[outName].attrs['units'] = units
-                dsOut[outName].attrs['description'] = description
-
-            dsOut['totalArea'] = totalArea
-            dsOut.totalArea.attrs['units'] = 'm^2'
-
-            datasets.append(dsOut)
-
-        # Combine data sets into a single data set for all regions
-        dsOut = xarray.concat(datasets, 'nRegions')
-        dsOut['refBottomDepth'] = refBottomDepth
-
-        write_netcdf(dsOut, timeSeriesFile)
+    print('\nComputing regional time series for year={}'.format(year))
+
+    datasets = []
+    for month in range(1, 13):
+        inputFile = '{}/{}.mpaso.hist.am.timeSeriesStatsMonthly.{:04d}-{:02d}-01.nc'.format(
+            modeldir, runName, year, month)
+        if not os.path.exists(inputFile):
+            raise IOError('Input file: {} not found'.format(inputFile))
+
+        dsTimeSlice = open_mpas_dataset(fileName=inputFile,
+                                        calendar=calendar,
+                                        variableList=variableList,
+                                        startDate=startDate,
+                                        endDate=endDate)
+        datasets.append(dsTimeSlice)
+    # combine data sets into a single data set
+    dsIn = xarray.concat(datasets, 'Time')
+
+    # Global depth-masked layer thickness (layer volume is obtained by
+    # multiplying by the cell areas stored in regionWeights)
+    layerThickness = dsIn.timeMonthly_avg_layerThickness
+    layerThickness = layerThickness.where(depthMask, drop=False)
+    layerThickness = layerThickness.transpose('Time', 'nCells',
+                                              'nVertLevels').values
+    layerVolSum = compute_regional_sums(regionWeights, layerThickness)
+
+    dsOut = xarray.Dataset()
+    dsOut['Time'] = dsIn.Time
+    # Compute layer-volume weighted averages (or sums for OHC) for all
+    # regions at once
+    for var in variables:
+        outName = var['name']
+        mpasVarName = var['mpas']
+        units = var['units']
+        factor = var['fac']
+        description = var['title']
+
+        timeSeries = dsIn[mpasVarName]
+        timeSeries = timeSeries.where(depthMask, drop=False)
+        timeSeries = timeSeries.transpose('Time', 'nCells',
+                                          'nVertLevels').values
+        timeSeries = compute_regional_sums(regionWeights,
+                                           layerThickness*timeSeries)
+        if outName!='ohc':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                timeSeries = timeSeries / layerVolSum
+
+        dsOut[outName] = (('nRegions', 'Time', 'nVertLevels'),
+                          factor*timeSeries)
+        dsOut[outName].attrs['units'] = units
+        dsOut[outName].attrs['description'] = description
+
+    dsOut['totalArea'] = ('nRegions', totalArea)
+    dsOut.totalArea.attrs['units'] = 'm^2'
+    dsOut['refBottomDepth'] = refBottomDepth
+
+    tempFile = '{}.tmp{}'.format(timeSeriesFile, os.getpid())
+    write_netcdf(dsOut, tempFile)
+    os.replace(tempFile, timeSeriesFile)
+
+    return timeSeriesFile
+
+
+# Compute regional averages one year at a time for years that are neither in
+# the consolidated time series store nor already computed
+storedYears = get_time_series_store_years(timeSeriesStoreFile)
+missingYears = []
+for year in years:
+    timeSeriesFile = '{}_year{:04d}.nc'.format(timeSeriesFile0, year)
+    if year in storedYears:
+        print('Time series already stored for year {}. Skipping it...'.format(year))
+    elif not os.path.exists(timeSeriesFile):
+        missingYears.append(year)
     else:
         print('Time series file already exists for year {}. Skipping it...'.format(year))
 
-# Make plot
-timeSeriesFiles = []
+if args.workers > 1 and len(missingYears) > 1:
+    # Years are independent, so spread them over a pool of processes.  The
+    # workers are forked so they inherit the mesh, masks and region weights.
+    pool = multiprocessing.get_context('fork').Pool(processes=args.workers)
+    for timeSeriesFile in pool.imap_unordered(compute_year_time_series,
+                                              missingYears):
+        print('Wrote {}'.format(timeSeriesFile))
+    pool.close()
+    pool.join()
+else:
+    for year in missingYears:
+        compute_year_time_series(year)
+
+# Add the new years to the store in year order (years before the last stored
+# year are inserted), removing the yearly files once they have been stored
 for year in years:
+    if year in storedYears:
+        continue
     timeSeriesFile = '{}_year{:04d}.nc'.format(timeSeriesFile0, year)
-    timeSeriesFiles.append(timeSeriesFile)
+    print('Storing year {} in {}'.format(year, timeSeriesStoreFile))
+    with xarray.open_dataset(timeSeriesFile, decode_times=False) as dsYear:
+        append_to_time_series_store(timeSeriesStoreFile, dsYear.load(), year)
+    os.remove(timeSeriesFile)
+
+# Make plot
+dsStore = open_time_series_store(timeSeriesStoreFile, startYear, endYear)
+
+# Compute moving averages of the anomalies with respect to the first-year
+# average (note that this assumes monthly fields) for all regions and
+# variables at once
+movingAverageMonths = 12
+anomalies = compute_moving_average_anomalies(
+    dsStore, [var['name'] for var in variables], movingAverageMonths)
 
 if os.path.exists(featureFile):
     fcAll = read_feature_collection(featureFile)
 else:
     raise IOError('No feature file found')
 
-for regionIndex, regionName in enumerate(regionNames):
-    print('    region: {}'.format(regionName))
+depths = dsStore.refBottomDepth.values
+z = np.zeros(depths.shape)
+z[0] = -0.5 * depths[0]
+z[1:] = -0.5 * (depths[0:-1] + depths[1:])
+
+Time = dsStore.Time.values[movingAverageMonths-1:]
+dsStore.close()
+
+# Inset maps for each region, drawn with cartopy once per process and reused
+# by all the figures for that region
+insetCache = {}
+
+
+def get_region_features(regionName):
+    """
+    Returns a feature collection with only the given region
+    """
     fc = FeatureCollection()
     for feature in fcAll.features:
         if feature['properties']['name'] == regionName:
             fc.add_feature(feature)
             break
+    return fc
 
-    dsIn = xarray.open_mfdataset(timeSeriesFiles, combine='nested',
-                                 concat_dim='Time', decode_times=False).isel(nRegions=regionIndex)
-
-    movingAverageMonths = 12
-
-    depths = dsIn.refBottomDepth.values[0]
-    z = np.zeros(depths.shape)
-    z[0] = -0.5 * depths[0]
-    z[1:] = -0.5 * (depths[0:-1] + depths[1:])
 
-    Time = dsIn.Time.values
+def plot_region(regionIndex):
+    """
+    Plot the Hovmoeller diagrams of all variables for one region
+    """
+    regionName = regionNames[regionIndex]
+    print('    region: {}'.format(regionName))
 
     for var in variables:
         varName = var['name']
@@ -249,23 +302,7 @@ for regionIndex, regionName in enumerate(regionNames):
         colormap.set_over(overColor)
         cnorm = mpl.colors.BoundaryNorm(clevels, colormap.N)
 
-        field = dsIn[varName]
-
-        # Compute first-year average (note that this assumes monthly fields)
-        fieldMean = field.isel(Time=range(12)).mean(dim='Time')
-
-        # Compute moving average of the anomaly with respect to first-year average
-        if movingAverageMonths != 1:
-            N = movingAverageMonths
-            movingAverageDepthSlices = []
-            for nVertLevel in range(nVertLevels):
-                depthSlice = field.isel(nVertLevels=nVertLevel) - fieldMean.isel(nVertLevels=nVertLevel)
-                mean = pd.Series.rolling(depthSlice.to_series(), N,
-                                         center=True).mean()
-                mean = xarray.DataArray.from_series(mean)
-                mean = mean[int(N / 2.0):-int(round(N / 2.0) - 1)]
-                movingAverageDepthSlices.append(mean)
-            field = xarray.DataArray(movingAverageDepthSlices)
+        field = anomalies[varName][regionIndex, :, :]
 
         xLabel = 'Time (yr)'
         yLabel = '{} ({})'.format(var['title'], var['units'])
@@ -273,7 +310,7 @@ for regionIndex, regionName in enumerate(regionNames):
         figFileName = '{}/{}vsTimeDepth_{}.png'.format(figdir, varName,
                 regionName[0].lower()+regionName[1:].replace(' ', ''))
 
-        fig = hovmoeller_plot(Time[N-1:], z, field.values, colormap, cnorm, clevels,
+        fig = hovmoeller_plot(Time, z, field, colormap, cnorm, clevels,
                               title, xLabel, yLabel, calendar, colorbarLabel=var['units'],
                               titleFontSize=None, figsize=(15, 6), dpi=None)
 
@@ -282,8 +319,23 @@ for regionIndex, regionName in enumerate(regionNames):
         plt.tight_layout()
 
         if regionName!='Global':
-            add_inset(fig, fc, width=1.5, height=1.5, xbuffer=0.5, ybuffer=-1)
+            add_inset(fig, get_region_features(regionName), width=1.5,
+                      height=1.5, xbuffer=0.5, ybuffer=-1, cache=insetCache)
 
         plt.savefig(figFileName, dpi='figure', bbox_inches='tight',
                     pad_inches=0.1)
         plt.close()
+
+
+if args.workers > 1:
+    # The figure data are computed above, so workers only render.  They are
+    # forked (inheriting the anomalies and features) and use the Agg backend.
+    pool = multiprocessing.get_context('fork').Pool(
+        processes=args.workers, initializer=plt.switch_backend,
+        initargs=('Agg',))
+    pool.map(plot_region, range(len(regionNames)), chunksize=1)
+    pool.close()
+    pool.join()
+else:
+    for regionIndex in range(len(regionNames)):
+        plot_region(regionIndex)
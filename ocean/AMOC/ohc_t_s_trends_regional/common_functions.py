@@ -1,5 +1,5 @@
 """
-Functions for plotting
+Functions for computing regional averages and for plotting
 """
 # Authors
 # -------
@@ -8,10 +8,16 @@ Functions for plotting
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 
+import os
+import re
+import json
+import hashlib
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
 from matplotlib.ticker import FuncFormatter, FixedLocator
 import matplotlib.path
+import matplotlib.figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import cartopy
 import cartopy.crs as ccrs
 import shapely.geometry
@@ -19,6 +25,7 @@ from functools import partial
 import xarray as xr
 import pandas as pd
 import numpy as np
+import scipy.sparse
 import datetime
 import netCDF4
 
@@ -57,36 +64,72 @@ def days_to_datetime(days, calendar='gregorian', referenceDate='0001-01-01'):
     # -------
     # Xylar Asay-Davis
 
-    # Convert from MPAS calendar to NetCDF4 calendar names.
-    if calendar == 'gregorian_noleap':
-        calendar = 'noleap'
-    elif calendar != 'gregorian':
-        raise ValueError('Unsupported calendar {}'.format(calendar))
+    # dates are rounded to the nearest second
+    (year, month, day, hour, minute, second) = \
+        days_to_date_components(days, calendar, referenceDate)
+
+    if np.ndim(days) == 0:
+        return datetime.datetime(year=int(year), month=int(month),
+                                 day=int(day), hour=int(hour),
+                                 minute=int(minute), second=int(second))
+
+    datetimes = np.empty(np.shape(days), dtype=object)
+    for index in np.ndindex(datetimes.shape):
+        datetimes[index] = datetime.datetime(
+            year=int(year[index]), month=int(month[index]),
+            day=int(day[index]), hour=int(hour[index]),
+            minute=int(minute[index]), second=int(second[index]))
+    return datetimes
 
-    datetimes = netCDF4.num2date(days,
-                                 'days since {}'.format(referenceDate),
-                                 calendar=calendar)
 
-    # convert to datetime.datetime
-    if isinstance(datetimes, np.ndarray):
-        newDateTimes = []
-        for date in datetimes.flat:
-            newDateTimes.append(_round_datetime(date))
-        if len(newDateTimes) > 0:
-            datetimes = np.reshape(np.array(newDateTimes),
-                                      datetimes.shape)
+def days_to_date_components(days, calendar='gregorian',
+                            referenceDate='0001-01-01'):
+    """
+    Convert days since a reference date to integer date components using
+    vectorized integer arithmetic, without creating ``datetime`` objects.
 
-    else:
-        # Round datetimes to nearest second
-        (year, month, day, hour, minute, second, microsecond) = \
-            (datetimes.year, datetimes.month, datetimes.day, datetimes.hour, \
-             datetimes.minute, datetimes.second, datetimes.microsecond)
-        datetimes = datetime.datetime(year=year, month=month, day=day,
-                                      hour=hour, minute=minute, second=second)
-        add_seconds = int(1e-6 * microsecond + 0.5)
-        datetimes = datetimes + datetime.timedelta(0, add_seconds)
+    Parameters
+    ----------
+    days : float or array-like of floats
+        The number of days since the reference date.
 
-    return datetimes
+    calendar : {'gregorian', 'gregorian_noleap'}, optional
+        The MPAS calendar.  As for ``netCDF4``, the 'gregorian' calendar is
+        the Julian calendar before 1582-10-15 and the Gregorian calendar
+        afterwards.
+
+    referenceDate : str, optional
+        A reference date of the form::
+
+            0001-01-01
+            0001-01-01 00:00:00
+
+    Returns
+    -------
+    year, month, day, hour, minute, second : int or arrays of int
+        The date components, rounded to the nearest second, with the same
+        shape as ``days``
+
+    Raises
+    ------
+    ValueError
+        If an invalid ``referenceDate`` or ``calendar`` is supplied.
+    """
+    _check_calendar(calendar)
+    (refYear, refMonth, refDay, refHour, refMinute, refSecond) = \
+        _parse_reference_date(referenceDate)
+
+    refDayNumber = _date_to_day_number(refYear, refMonth, refDay, calendar)
+    seconds = np.round(np.asarray(days, dtype=float)*86400.).astype(np.int64)
+    seconds = seconds + 86400*refDayNumber + \
+        3600*refHour + 60*refMinute + refSecond
+
+    dayNumber, secondOfDay = np.divmod(seconds, 86400)
+    year, month, day = _day_number_to_date(dayNumber, calendar)
+    hour, secondOfHour = np.divmod(secondOfDay, 3600)
+    minute, second = np.divmod(secondOfHour, 60)
+
+    return year, month, day, hour, minute, second
 
 
 def date_to_days(year=1, month=1, day=1, hour=0, minute=0, second=0,
@@ -96,8 +139,8 @@ def date_to_days(year=1, month=1, day=1, hour=0, minute=0, second=0,
 
     Parameters
     ----------
-    year, month, day, hour, minute, second : int, optional
-        The date to be converted to days since ``referenceDate`` on the
+    year, month, day, hour, minute, second : int or array-like of int, optional
+        The date(s) to be converted to days since ``referenceDate`` on the
         given ``calendar``.
 
     calendar : {'gregorian', 'gregorian_noleap'}, optional
@@ -112,7 +155,7 @@ def date_to_days(year=1, month=1, day=1, hour=0, minute=0, second=0,
 
     Returns
     -------
-    days : float
+    days : float or array of floats
         The days since ``referenceDate`` on the given ``calendar``.
 
     Raises
@@ -124,16 +167,94 @@ def date_to_days(year=1, month=1, day=1, hour=0, minute=0, second=0,
     # -------
     # Xylar Asay-Davis
 
-    date = datetime.datetime(year, month, day, hour, minute, second)
+    _check_calendar(calendar)
+    (refYear, refMonth, refDay, refHour, refMinute, refSecond) = \
+        _parse_reference_date(referenceDate)
 
-    # Convert from MPAS calendar to NetCDF4 calendar names.
-    if calendar == 'gregorian_noleap':
-        calendar = 'noleap'
-    elif calendar != 'gregorian':
+    dayNumber = _date_to_day_number(year, month, day, calendar)
+    refDayNumber = _date_to_day_number(refYear, refMonth, refDay, calendar)
+    seconds = 3600*(np.asarray(hour) - refHour) + \
+        60*(np.asarray(minute) - refMinute) + (np.asarray(second) - refSecond)
+
+    days = (dayNumber - refDayNumber) + seconds/86400.
+    if np.ndim(days) == 0:
+        days = float(days)
+    return days
+
+
+def _check_calendar(calendar):
+    """Raise an exception if the calendar is not a supported MPAS calendar"""
+    if calendar not in ['gregorian', 'gregorian_noleap']:
         raise ValueError('Unsupported calendar {}'.format(calendar))
 
-    return netCDF4.date2num(date, 'days since {}'.format(referenceDate),
-                            calendar=calendar)
+
+def _parse_reference_date(referenceDate):
+    """
+    Parse a reference date of the form 0001-01-01 or 0001-01-01 00:00:00 into
+    (year, month, day, hour, minute, second)
+    """
+    components = [int(component) for component in
+                  re.split('[^0-9]+', referenceDate.strip()) if component]
+    if len(components) < 1 or len(components) > 6:
+        raise ValueError('Invalid reference date {}'.format(referenceDate))
+    defaults = [1, 1, 1, 0, 0, 0]
+    return tuple(components + defaults[len(components):])
+
+
+# the cumulative number of days before each month in a year without leap day
+_daysBeforeMonth = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304,
+                             334, 365])
+
+# the Julian day number of the first day of the Gregorian calendar,
+# 1582-10-15
+_gregorianStartDayNumber = 2299161
+
+
+def _date_to_day_number(year, month, day, calendar):
+    """
+    Convert dates to integer day numbers (Julian day numbers for the
+    'gregorian' calendar or days since 0001-01-01 for 'gregorian_noleap')
+    """
+    year = np.asarray(year, dtype=np.int64)
+    month = np.asarray(month, dtype=np.int64)
+    day = np.asarray(day, dtype=np.int64)
+
+    if calendar == 'gregorian_noleap':
+        return 365*(year - 1) + _daysBeforeMonth[month - 1] + day - 1
+
+    # shift the year to start in March so leap days come at the end
+    a = (14 - month)//12
+    y = year + 4800 - a
+    m = month + 12*a - 3
+    dayNumber = day + (153*m + 2)//5 + 365*y + y//4
+    isGregorian = 10000*year + 100*month + day >= 15821015
+    return np.where(isGregorian, dayNumber - y//100 + y//400 - 32045,
+                    dayNumber - 32083)
+
+
+def _day_number_to_date(dayNumber, calendar):
+    """
+    Convert integer day numbers (as returned by ``_date_to_day_number()``)
+    back to year, month and day
+    """
+    dayNumber = np.asarray(dayNumber, dtype=np.int64)
+
+    if calendar == 'gregorian_noleap':
+        year, dayOfYear = np.divmod(dayNumber, 365)
+        month = np.searchsorted(_daysBeforeMonth, dayOfYear, side='right')
+        day = dayOfYear - _daysBeforeMonth[month - 1] + 1
+        return year + 1, month, day
+
+    # Richards' algorithm for the Julian and Gregorian calendars
+    f = dayNumber + 1401
+    f = np.where(dayNumber >= _gregorianStartDayNumber,
+                 f + (((4*dayNumber + 274277)//146097)*3)//4 - 38, f)
+    e = 4*f + 3
+    h = 5*((e % 1461)//4) + 2
+    day = (h % 153)//5 + 1
+    month = (h//153 + 2) % 12 + 1
+    year = e//1461 - 4716 + (14 - month)//12
+    return year, month, day
 
 
 def plot_xtick_format(calendar, minDays, maxDays, maxXTicks, yearStride=None):
@@ -164,33 +285,35 @@ def plot_xtick_format(calendar, minDays, maxDays, maxXTicks, yearStride=None):
 
     def date_tick(days, pos, calendar='gregorian', includeMonth=True):
         days = np.maximum(days, 0.)
-        date = days_to_datetime(days, calendar)
+        year, month = days_to_date_components(days, calendar)[0:2]
         if includeMonth:
-            return '{:04d}-{:02d}'.format(date.year, date.month)
+            return '{:04d}-{:02d}'.format(int(year), int(month))
         else:
-            return '{:04d}'.format(date.year)
+            return '{:04d}'.format(int(year))
 
     ax = plt.gca()
 
-    start = days_to_datetime(np.amin(minDays), calendar=calendar)
-    end = days_to_datetime(np.amax(maxDays), calendar=calendar)
+    startYear = int(days_to_date_components(np.amin(minDays),
+                                            calendar=calendar)[0])
+    endYear = int(days_to_date_components(np.amax(maxDays),
+                                          calendar=calendar)[0])
 
-    if yearStride is not None or end.year - start.year > maxXTicks / 2:
+    if yearStride is not None or endYear - startYear > maxXTicks / 2:
         if yearStride is None:
             yearStride = 1
         else:
             maxXTicks = None
-        major = [date_to_days(year=year, calendar=calendar)
-                 for year in np.arange(start.year, end.year + 1, yearStride)]
+        major = date_to_days(year=np.arange(startYear, endYear + 1,
+                                            yearStride),
+                             calendar=calendar)
         formatterFun = partial(date_tick, calendar=calendar,
                                includeMonth=False)
     else:
         # add ticks for months
-        major = []
-        for year in range(start.year, end.year + 1):
-            for month in range(1, 13):
-                major.append(date_to_days(year=year, month=month,
-                                          calendar=calendar))
+        nYears = endYear - startYear + 1
+        major = date_to_days(
+            year=np.repeat(np.arange(startYear, endYear + 1), 12),
+            month=np.tile(np.arange(1, 13), nYears), calendar=calendar)
         formatterFun = partial(date_tick, calendar=calendar,
                                includeMonth=True)
 
@@ -202,72 +325,363 @@ def plot_xtick_format(calendar, minDays, maxDays, maxXTicks, yearStride=None):
     plt.autoscale(enable=True, axis='x', tight=True)
 
 
-def subdivide_geom(geometry, geomtype, maxLength):
+def compute_moving_average(field, N, axis=0):
+    """
+    Compute an N-point moving average along one axis of an array using
+    cumulative sums, keeping only complete windows.
+
+    Parameters
+    ----------
+    field : numpy array
+        The field to average
+
+    N : int
+        The number of points in each averaging window
+
+    axis : int, optional
+        The axis (typically time) along which to average
+
+    Returns
+    -------
+    mean : numpy array
+        The moving average, with ``field.shape[axis] - N + 1`` entries along
+        ``axis`` (the average over entries ``i`` to ``i + N - 1``).  Windows
+        containing any NaN values are NaN.
+    """
+    field = np.moveaxis(np.asarray(field, dtype=float), axis, 0)
+    valid = np.isfinite(field)
+
+    shape = (1,) + field.shape[1:]
+    fieldSum = np.concatenate([np.zeros(shape),
+                               np.cumsum(np.where(valid, field, 0.), axis=0)])
+    validCount = np.concatenate([np.zeros(shape, dtype=int),
+                                 np.cumsum(valid, axis=0)])
+
+    mean = (fieldSum[N:, ...] - fieldSum[:-N, ...]) / N
+    mean[validCount[N:, ...] - validCount[:-N, ...] < N] = np.nan
+
+    return np.moveaxis(mean, 0, axis)
+
+
+def compute_moving_average_anomalies(ds, variableNames, N,
+                                     referenceMonths=12):
+    """
+    Compute moving averages of anomalies with respect to the initial
+    (e.g. first-year) mean for several variables and all regions at once.
+
+    Parameters
+    ----------
+    ds : ``xarray.Dataset``
+        A data set with variables of dimension ``nRegions`` x ``Time`` x
+        ``nVertLevels``
+
+    variableNames : list of str
+        The variables to process
+
+    N : int
+        The number of time points in the moving average (1 for no moving
+        average)
+
+    referenceMonths : int, optional
+        The number of initial time points used to compute the reference mean
+
+    Returns
+    -------
+    anomalies : dict of numpy arrays
+        For each variable, an ``nRegions`` x ``nVertLevels`` x
+        ``nTime - N + 1`` array, ready to pass to ``hovmoeller_plot()`` with
+        ``Time[N-1:]`` for each region
+    """
+    anomalies = {}
+    for varName in variableNames:
+        field = ds[varName].transpose('nRegions', 'Time', 'nVertLevels').values
+        with np.errstate(invalid='ignore'):
+            reference = np.nanmean(field[:, 0:referenceMonths, :], axis=1,
+                                   keepdims=True)
+        field = field - reference
+        if N is not None and N > 1:
+            field = compute_moving_average(field, N, axis=1)
+        anomalies[varName] = np.swapaxes(field, 1, 2)
+    return anomalies
+
+
+def compute_centered_moving_average(field, N):
+    """
+    Compute a centered N-point moving average of a 1D time series, with the
+    same alignment as ``pandas.Series.rolling(N, center=True).mean()``
+
+    Parameters
+    ----------
+    field : numpy array
+        The time series
+
+    N : int or ``None``
+        The number of points in the moving average (``None`` or 1 for no
+        averaging)
+
+    Returns
+    -------
+    mean : numpy array
+        The moving average, the same size as ``field`` with NaNs where the
+        averaging window is incomplete
+    """
+    field = np.asarray(field, dtype=float)
+    if N is None or N == 1:
+        return field
+    mean = np.nan*np.ones(field.shape)
+    if len(field) >= N:
+        mean[N//2:N//2 + len(field) - N + 1] = compute_moving_average(field, N)
+    return mean
+
+
+def decimate_min_max(field, nBins):
+    """
+    Find the indices of the minimum and maximum of a 1D time series in each of
+    ``nBins`` contiguous bins (e.g. one per pixel column of a plot), so that
+    plotting only these points looks the same as plotting the full series.
+
+    Parameters
+    ----------
+    field : numpy array
+        The time series
+
+    nBins : int
+        The number of bins
+
+    Returns
+    -------
+    indices : numpy array
+        Sorted indices of the points to keep (all points if there are fewer
+        than ``2*nBins``)
+    """
+    nTime = len(field)
+    if nTime <= 2*nBins:
+        return np.arange(nTime)
+
+    binSize = int(np.ceil(nTime/float(nBins)))
+    padded = np.nan*np.ones(nBins*binSize)
+    padded[0:nTime] = field
+    padded = padded.reshape(nBins, binSize)
+    invalid = np.isnan(padded)
+
+    offsets = binSize*np.arange(nBins)
+    minIndices = offsets + np.argmin(np.where(invalid, np.inf, padded), axis=1)
+    maxIndices = offsets + np.argmax(np.where(invalid, -np.inf, padded),
+                                     axis=1)
+
+    indices = np.unique(np.concatenate([[0, nTime-1], minIndices, maxIndices]))
+    return indices[indices < nTime]
+
+
+def subdivide_geom(geometry, geomtype, maxLength, greatCircle=False):
     '''
     Subdivide the line segments for a given set of geometry so plots are
     smoother
+
+    Parameters
+    ----------
+    geometry : ``shapely.geometry`` object
+        The geometry to subdivide
+
+    geomtype : str
+        The geometry type (e.g. ``geometry.geom_type``)
+
+    maxLength : float
+        The maximum length of segments in the result (in degrees)
+
+    greatCircle : bool, optional
+        Whether new points should follow great circles between the original
+        vertices (assumed to be lon/lat in degrees) rather than straight lines
+
+    Returns
+    -------
+    newGeometry : ``shapely.geometry`` object
+        The subdivided geometry
     '''
     # Authors
     # -------
     # Xylar Asay-Davis, Phillip J. Wolfram
 
-    def subdivide_line_string(lineString, periodic=False):
-        coords = list(lineString.coords)
-        if periodic:
-            # add periodic last entry
-            coords.append(coords[0])
-
-        outCoords = [coords[0]]
-        for iVert in range(len(coords)-1):
-            segment = shapely.geometry.LineString([coords[iVert],
-                                                   coords[iVert+1]])
-            if(segment.length < maxLength):
-                outCoords.append(coords[iVert+1])
-            else:
-                # we need to subdivide this segment
-                subsegment_count = int(np.ceil(segment.length/maxLength))
-                for index in range(subsegment_count):
-                    point = segment.interpolate(
-                        float(index+1)/float(subsegment_count),
-                        normalized=True)
-                    outCoords.append(point.coords[0])
-
-        if periodic:
-            # remove the last entry
-            outCoords.pop()
-        return outCoords
-
+    # gather all the line strings and rings so they are subdivided at once
     if geomtype == 'LineString':
-        newGeometry = shapely.geometry.LineString(
-            subdivide_line_string(geometry))
+        lines = [geometry]
+        periodic = [False]
     elif geomtype == 'MultiLineString':
-        outStrings = [subdivide_line_string(inLineString) for inLineString
-                      in geometry]
-        newGeometry = shapely.geometry.MultiLineString(outStrings)
-    elif geomtype == 'Polygon':
-        exterior = subdivide_line_string(geometry.exterior, periodic=True)
-        interiors = [subdivide_line_string(inLineString, periodic=True)
-                     for inLineString in geometry.interiors]
-        newGeometry = shapely.geometry.Polygon(exterior, interiors)
-    elif geomtype == 'MultiPolygon':
-        polygons = []
-        for polygon in geometry:
-            exterior = subdivide_line_string(polygon.exterior, periodic=True)
-            interiors = [subdivide_line_string(inLineString, periodic=True)
-                         for inLineString in polygon.interiors]
-            polygons.append((exterior, interiors))
-
-        newGeometry = shapely.geometry.MultiPolygon(polygons)
+        lines = list(geometry.geoms)
+        periodic = [False]*len(lines)
+    elif geomtype in ['Polygon', 'MultiPolygon']:
+        if geomtype == 'Polygon':
+            polygons = [geometry]
+        else:
+            polygons = list(geometry.geoms)
+        lines = []
+        for polygon in polygons:
+            lines.append(polygon.exterior)
+            lines.extend(polygon.interiors)
+        periodic = [True]*len(lines)
     elif geomtype == 'Point':
-        newGeometry = geometry
+        return geometry
     else:
         print("Warning: subdividing geometry type {} is not supported.".format(
             geomtype))
-        newGeometry = geometry
+        return geometry
+
+    outCoords = subdivide_line_strings([np.array(line.coords) for line in lines],
+                                       maxLength, periodic, greatCircle)
+
+    if geomtype == 'LineString':
+        newGeometry = shapely.geometry.LineString(outCoords[0])
+    elif geomtype == 'MultiLineString':
+        newGeometry = shapely.geometry.MultiLineString(outCoords)
+    else:
+        newPolygons = []
+        lineIndex = 0
+        for polygon in polygons:
+            nInteriors = len(polygon.interiors)
+            exterior = outCoords[lineIndex]
+            interiors = outCoords[lineIndex+1:lineIndex+1+nInteriors]
+            lineIndex += 1 + nInteriors
+            newPolygons.append((exterior, interiors))
+        if geomtype == 'Polygon':
+            newGeometry = shapely.geometry.Polygon(*newPolygons[0])
+        else:
+            newGeometry = shapely.geometry.MultiPolygon(newPolygons)
 
     return newGeometry
 
 
+def subdivide_line_strings(coords, maxLength, periodic=False,
+                           greatCircle=False):
+    '''
+    Subdivide segments of a batch of line strings (or rings) that are longer
+    than ``maxLength`` into equal pieces, processing all segments at once
+
+    Parameters
+    ----------
+    coords : list of numpy arrays
+        The coordinates (npoints x 2 or npoints x 3) of each line string, with
+        longitude and latitude in degrees if ``greatCircle = True``
+
+    maxLength : float
+        The maximum length of segments in the result (in degrees)
+
+    periodic : bool or list of bool, optional
+        Whether each line string should be treated as closed
+
+    greatCircle : bool, optional
+        Whether new points should follow great circles between the original
+        vertices rather than straight lines in lon/lat
+
+    Returns
+    -------
+    outCoords : list of numpy arrays
+        The subdivided coordinates of each line string
+    '''
+    nLines = len(coords)
+    if nLines == 0:
+        return []
+    if np.ndim(periodic) == 0:
+        periodic = [periodic]*nLines
+
+    # add a periodic last entry where needed and stack all the vertices
+    lineCoords = []
+    for lineIndex in range(nLines):
+        lineCoord = np.asarray(coords[lineIndex], dtype=float)
+        if periodic[lineIndex]:
+            lineCoord = np.concatenate([lineCoord, lineCoord[0:1, :]])
+        lineCoords.append(lineCoord)
+    nVertices = np.array([len(lineCoord) for lineCoord in lineCoords])
+    allCoords = np.concatenate(lineCoords)
+
+    # segments connect consecutive vertices within the same line string
+    lineEnds = np.cumsum(nVertices)
+    isSegmentStart = np.ones(len(allCoords), bool)
+    isSegmentStart[lineEnds - 1] = False
+    segmentStart = np.nonzero(isSegmentStart)[0]
+    start = allCoords[segmentStart, :]
+    end = allCoords[segmentStart + 1, :]
+
+    if greatCircle:
+        startVector = _lon_lat_to_unit_vector(start)
+        endVector = _lon_lat_to_unit_vector(end)
+        angle = np.arccos(np.clip(np.sum(startVector*endVector, axis=1),
+                                  -1., 1.))
+        length = np.rad2deg(angle)
+    else:
+        length = np.sqrt(np.sum((end[:, 0:2] - start[:, 0:2])**2, axis=1))
+
+    subsegmentCount = np.where(length < maxLength, 1,
+                               np.ceil(length/maxLength)).astype(int)
+
+    # the fraction along its segment of each new point
+    segmentIndices = np.repeat(np.arange(len(segmentStart)), subsegmentCount)
+    firstSubsegment = np.cumsum(subsegmentCount) - subsegmentCount
+    subsegment = np.arange(len(segmentIndices)) - \
+        np.repeat(firstSubsegment, subsegmentCount) + 1
+    fraction = subsegment/subsegmentCount[segmentIndices].astype(float)
+
+    start = start[segmentIndices, :]
+    end = end[segmentIndices, :]
+    points = start + fraction[:, np.newaxis]*(end - start)
+    if greatCircle:
+        points[:, 0:2] = _slerp_lon_lat(start, end, angle[segmentIndices],
+                                        fraction)
+    # make sure segment ends are exactly the original vertices
+    isEnd = subsegment == subsegmentCount[segmentIndices]
+    points[isEnd, :] = end[isEnd, :]
+
+    # each line string gets its first vertex followed by its new points
+    segmentLine = np.repeat(np.arange(nLines), nVertices - 1)
+    pointLine = segmentLine[segmentIndices]
+    pointsPerLine = np.bincount(pointLine, minlength=nLines)
+    lineStarts = np.cumsum(pointsPerLine) - pointsPerLine
+
+    outCoords = []
+    for lineIndex in range(nLines):
+        first = lineCoords[lineIndex][0:1, :]
+        linePoints = points[lineStarts[lineIndex]:
+                            lineStarts[lineIndex]+pointsPerLine[lineIndex], :]
+        lineCoord = np.concatenate([first, linePoints])
+        if periodic[lineIndex]:
+            # remove the last entry
+            lineCoord = lineCoord[0:-1, :]
+        outCoords.append(lineCoord)
+
+    return outCoords
+
+
+def _lon_lat_to_unit_vector(coords):
+    '''Convert lon/lat in degrees (the first 2 columns) to unit vectors'''
+    lon = np.deg2rad(coords[:, 0])
+    lat = np.deg2rad(coords[:, 1])
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon),
+                     np.sin(lat)], axis=1)
+
+
+def _slerp_lon_lat(start, end, angle, fraction):
+    '''
+    Interpolate along great circles from start to end (lon/lat in degrees),
+    returning lon/lat with longitude kept continuous with the start point
+    '''
+    startVector = _lon_lat_to_unit_vector(start)
+    endVector = _lon_lat_to_unit_vector(end)
+    sinAngle = np.sin(angle)
+    small = sinAngle < 1e-12
+    sinAngle[small] = 1.
+    startWeight = np.where(small, 1. - fraction,
+                           np.sin((1. - fraction)*angle)/sinAngle)
+    endWeight = np.where(small, fraction, np.sin(fraction*angle)/sinAngle)
+    vector = startWeight[:, np.newaxis]*startVector + \
+        endWeight[:, np.newaxis]*endVector
+
+    lon = np.rad2deg(np.arctan2(vector[:, 1], vector[:, 0]))
+    lat = np.rad2deg(np.arctan2(vector[:, 2],
+                                np.sqrt(vector[:, 0]**2 + vector[:, 1]**2)))
+    # keep longitude continuous with the start of the segment
+    lon = start[:, 0] + np.mod(lon - start[:, 0] + 180., 360.) - 180.
+    return np.stack([lon, lat], axis=1)
+
+
 def timeseries_analysis_plot(dsvalues, N, title, xlabel, ylabel,
                              calendar, lineColors=None,
                              lineStyles=None, markers=None, lineWidths=None,
@@ -369,20 +783,23 @@ def timeseries_analysis_plot(dsvalues, N, title, xlabel, ylabel,
         dsvalue = dsvalues[dsIndex]
         if dsvalue is None:
             continue
-        if N == 1 or N is None:
-            mean = dsvalue
-        else:
-            mean = pd.Series.rolling(dsvalue.to_pandas(), N,
-                                     center=True).mean()
-            mean = xr.DataArray.from_series(mean)
-        minDays.append(mean.Time.min())
-        maxDays.append(mean.Time.max())
+        time = dsvalue['Time'].values
+        mean = compute_centered_moving_average(dsvalue.values, N)
+        minDays.append(np.amin(time))
+        maxDays.append(np.amax(time))
 
         if maxPoints is not None and maxPoints[dsIndex] is not None:
-            nTime = mean.sizes['Time']
+            nTime = len(time)
             if maxPoints[dsIndex] < nTime:
                 stride = int(round(nTime / float(maxPoints[dsIndex])))
-                mean = mean.isel(Time=slice(0, None, stride))
+                time = time[::stride]
+                mean = mean[::stride]
+        elif markers is None or markers[dsIndex] is None:
+            # keep the min and max in each pixel column, which looks the same
+            # as the full series but is much smaller and faster to draw
+            indices = decimate_min_max(mean, int(figsize[0]*dpi))
+            time = time[indices]
+            mean = mean[indices]
 
         if legendText is None:
             label = None
@@ -406,7 +823,7 @@ def timeseries_analysis_plot(dsvalues, N, title, xlabel, ylabel,
         else:
             linewidth = lineWidths[dsIndex]
 
-        plt.plot(mean['Time'].values, mean.values, color=color,
+        plt.plot(time, mean, color=color,
                  linestyle=linestyle, marker=marker, linewidth=linewidth,
                  label=label)
 
@@ -688,7 +1105,7 @@ def hovmoeller_plot(Time, z, field, colormap, cnorm, clevels,
 
 def add_inset(fig, fc, latlonbuffer=45., polarbuffer=5., width=1.0,
               height=1.0, lowerleft=None, xbuffer=None, ybuffer=None,
-              maxlength=1.):
+              maxlength=1., cache=None, rasterize=True):
     '''
     Plots an inset map showing the location of a transect or polygon.  Shapes
     are plotted on a polar grid if they are entirely poleward of +/-50 deg.
@@ -725,6 +1142,18 @@ def add_inset(fig, fc, latlonbuffer=45., polarbuffer=5., width=1.0,
         Any segments longer than maxlength will be subdivided in the plot to
         ensure curvature.  If ``None``, no subdivision is performed.
 
+    cache : dict, optional
+        A dictionary in which insets are cached, keyed by the feature
+        collection, projection, extent and size of the inset.  If supplied,
+        cartopy is only used to draw the first inset for a given key and
+        later figures reuse the result.
+
+    rasterize : bool, optional
+        If ``cache`` is supplied, whether the inset is cached as an RGBA
+        image that is composited into later figures (fastest) or as
+        geometries already projected to the inset's projection, so the inset
+        stays vector
+
     Returns
     -------
     inset : ``matplotlib.axes.Axes``
@@ -734,31 +1163,18 @@ def add_inset(fig, fc, latlonbuffer=45., polarbuffer=5., width=1.0,
     # -------
     # Xylar Asay-Davis
 
-    def set_circular_boundary(ax):
-        '''Set the boundary of the given axis to be circular (for a polar plot)'''
-
-        # Compute a circle in axes coordinates, which we can use as a boundary
-        # for the map. We can pan/zoom as much as we like - the boundary will be
-        # permanently circular.
-        theta = np.linspace(0, 2*np.pi, 100)
-        center, radius = [0.5, 0.5], 0.5
-        verts = np.vstack([np.sin(theta), np.cos(theta)]).T
-        circle = matplotlib.path.Path(verts * radius + center)
-        ax.set_boundary(circle, transform=ax.transAxes)
-
     def get_bounds(fc):
         '''Compute the lon/lat bounding box for all transects and regions'''
 
-        bounds = shapely.geometry.GeometryCollection()
-        for feature in fc.features:
-            shape = shapely.geometry.shape(feature['geometry'])
-            shape_bounds = shapely.geometry.box(*shape.bounds)
-            bounds = shapely.geometry.box(*(bounds.union(shape_bounds).bounds))
-        return bounds.bounds
+        bounds = np.array([shapely.geometry.shape(feature['geometry']).bounds
+                           for feature in fc.features])
+        return (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(),
+                bounds[:, 3].max())
 
     minLon, minLat, maxLon, maxLat = get_bounds(fc)
 
     figsize = fig.get_size_inches()
+    insetSize = (width, height)
     width /= figsize[0]
     height /= figsize[1]
     if lowerleft is None:
@@ -777,27 +1193,83 @@ def add_inset(fig, fc, latlonbuffer=45., polarbuffer=5., width=1.0,
 
     if maxLat <= -50:
         # an Antarctic-focused map makes the most sense
-        inset = fig.add_axes(bounds,
-                             projection=ccrs.SouthPolarStereo())
+        projection = ccrs.SouthPolarStereo()
         extent = [-180., 180., -90., max(-65., maxLat+polarbuffer)]
-        set_circular_boundary(inset)
-        xlocator = mticker.FixedLocator(np.linspace(-180., 180., 9))
-        ylocator = mticker.FixedLocator(np.linspace(-90., -50., 9))
+        circular = True
     elif minLat >= 50:
         # an Arctic-focused map makes the most sense
-        inset = fig.add_axes(bounds,
-                             projection=ccrs.NorthPolarStereo())
+        projection = ccrs.NorthPolarStereo()
         extent = [-180, 180, min(65., minLat-polarbuffer), 90]
-        set_circular_boundary(inset)
-        xlocator = mticker.FixedLocator(np.linspace(-180., 180., 9))
-        ylocator = mticker.FixedLocator(np.linspace(50., 90., 9))
+        circular = True
     else:
-        inset = fig.add_axes(bounds,
-                             projection=ccrs.PlateCarree())
+        projection = ccrs.PlateCarree()
         extent = [max(-180., minLon-latlonbuffer),
                   min(180., maxLon+latlonbuffer),
                   max(-90., minLat-latlonbuffer),
                   min(90., maxLat+latlonbuffer)]
+        circular = False
+
+    if cache is None:
+        return _draw_inset(fig, bounds, fc, projection, extent, circular,
+                           maxlength)
+
+    key = (_feature_collection_hash(fc), type(projection).__name__,
+           tuple(extent), insetSize, fig.dpi, maxlength, rasterize)
+
+    if not rasterize:
+        if key not in cache:
+            cache[key] = _project_inset_geometries(fc, projection, extent,
+                                                   maxlength)
+        return _draw_inset(fig, bounds, fc, projection, extent, circular,
+                           maxlength, projected=cache[key])
+
+    if key not in cache:
+        # draw the inset once on its own transparent figure of the same
+        # size and keep the pixels
+        insetFig = matplotlib.figure.Figure(figsize=insetSize, dpi=fig.dpi)
+        canvas = FigureCanvasAgg(insetFig)
+        insetFig.patch.set_alpha(0.)
+        _draw_inset(insetFig, [0., 0., 1., 1.], fc, projection, extent,
+                    circular, maxlength)
+        canvas.draw()
+        cache[key] = np.array(canvas.buffer_rgba())
+
+    inset = fig.add_axes(bounds)
+    inset.imshow(cache[key], extent=[0., 1., 0., 1.], aspect='auto',
+                 interpolation='none')
+    inset.set_axis_off()
+    return inset
+
+
+def _draw_inset(fig, bounds, fc, projection, extent, circular, maxlength,
+                projected=None):
+    '''
+    Draw an inset map with cartopy.  If ``projected`` is supplied, it
+    contains land, ocean and feature geometries already projected by
+    ``_project_inset_geometries()``.
+    '''
+
+    def set_circular_boundary(ax):
+        '''Set the boundary of the given axis to be circular (for a polar plot)'''
+
+        # Compute a circle in axes coordinates, which we can use as a boundary
+        # for the map. We can pan/zoom as much as we like - the boundary will be
+        # permanently circular.
+        theta = np.linspace(0, 2*np.pi, 100)
+        center, radius = [0.5, 0.5], 0.5
+        verts = np.vstack([np.sin(theta), np.cos(theta)]).T
+        circle = matplotlib.path.Path(verts * radius + center)
+        ax.set_boundary(circle, transform=ax.transAxes)
+
+    inset = fig.add_axes(bounds, projection=projection)
+    if circular:
+        set_circular_boundary(inset)
+        xlocator = mticker.FixedLocator(np.linspace(-180., 180., 9))
+        if extent[2] < 0:
+            ylocator = mticker.FixedLocator(np.linspace(-90., -50., 9))
+        else:
+            ylocator = mticker.FixedLocator(np.linspace(50., 90., 9))
+    else:
         xlocator = None
         ylocator = None
 
@@ -806,8 +1278,25 @@ def add_inset(fig, fc, latlonbuffer=45., polarbuffer=5., width=1.0,
     inset.set_anchor('N')
 
     inset.set_extent(extent,  ccrs.PlateCarree())
-    inset.add_feature(cartopy.feature.LAND, zorder=1)
-    inset.add_feature(cartopy.feature.OCEAN, zorder=0)
+    if projected is None:
+        inset.add_feature(cartopy.feature.LAND, zorder=1)
+        inset.add_feature(cartopy.feature.OCEAN, zorder=0)
+        shapes = []
+        for feature in fc.features:
+            shape = shapely.geometry.shape(feature['geometry'])
+            if maxlength is not None:
+                shape = subdivide_geom(shape, shape.geom_type, maxlength)
+            shapes.append((feature['geometry']['type'], shape))
+        shapeCRS = ccrs.PlateCarree()
+    else:
+        inset.add_geometries(projected['land'], crs=projection,
+                             facecolor=cartopy.feature.COLORS['land'],
+                             edgecolor='face', zorder=1)
+        inset.add_geometries(projected['ocean'], crs=projection,
+                             facecolor=cartopy.feature.COLORS['water'],
+                             edgecolor='face', zorder=0)
+        shapes = projected['shapes']
+        shapeCRS = projection
 
     gl = inset.gridlines(crs=ccrs.PlateCarree(), draw_labels=False,
                          linewidth=0.5, color='gray', alpha=0.5,
@@ -819,31 +1308,282 @@ def add_inset(fig, fc, latlonbuffer=45., polarbuffer=5., width=1.0,
     if ylocator is not None:
         gl.ylocator = ylocator
 
-    for feature in fc.features:
-        geomtype = feature['geometry']['type']
-        shape = shapely.geometry.shape(feature['geometry'])
-        if maxlength is not None:
-            shape = subdivide_geom(shape, shape.geom_type, maxlength)
+    for feature, (geomtype, shape) in zip(fc.features, shapes):
         if geomtype in ['Polygon', 'MultiPolygon']:
-            inset.add_geometries((shape,), crs=ccrs.PlateCarree(),
+            inset.add_geometries((shape,), crs=shapeCRS,
                                  edgecolor='blue', facecolor='blue', alpha=0.4,
                                  linewidth=1.)
         elif geomtype in ['Point', 'MultiPoint']:
-            inset.add_geometries((shape,), crs=ccrs.PlateCarree(),
+            inset.add_geometries((shape,), crs=shapeCRS,
                                  edgecolor='none', facecolor='none', alpha=1.,
                                  markersize=3., markeredgecolor='k',
                                  markerfacecolor='k')
         else:
-            inset.add_geometries((shape,), crs=ccrs.PlateCarree(),
+            inset.add_geometries((shape,), crs=shapeCRS,
                                  edgecolor='k', facecolor='none', alpha=1.,
                                  linewidth=1.)
             # put a red point at the beginning and a blue point at the end
             # of the transect to help show the orientation
-            begin = shape.coords[0]
-            end = shape.coords[-1]
+            coords = shapely.geometry.shape(feature['geometry']).coords
+            begin = coords[0]
+            end = coords[-1]
             inset.plot(begin[0], begin[1], color='r', marker='o',
                        markersize=3., transform=ccrs.PlateCarree())
             inset.plot(end[0], end[1], color='g', marker='o',
                        markersize=3., transform=ccrs.PlateCarree())
 
     return inset
+
+
+def _project_inset_geometries(fc, projection, extent, maxlength):
+    '''
+    Project the land, ocean and feature geometries for an inset once so they
+    can be reused by later insets with the same projection and extent
+    '''
+    dataCRS = ccrs.PlateCarree()
+    projected = {}
+    for name, feature in [('land', cartopy.feature.LAND),
+                          ('ocean', cartopy.feature.OCEAN)]:
+        projected[name] = [projection.project_geometry(geometry, dataCRS)
+                           for geometry in
+                           feature.intersecting_geometries(extent)]
+    shapes = []
+    for feature in fc.features:
+        shape = shapely.geometry.shape(feature['geometry'])
+        if maxlength is not None:
+            shape = subdivide_geom(shape, shape.geom_type, maxlength)
+        shapes.append((feature['geometry']['type'],
+                       projection.project_geometry(shape, dataCRS)))
+    projected['shapes'] = shapes
+    return projected
+
+
+def _feature_collection_hash(fc):
+    '''Returns a hash of the features in a feature collection'''
+    return hashlib.sha1(json.dumps(fc.features, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def compute_region_weights(dsRegionMask, areaCell, openOceanMask=None):
+    """
+    Build a sparse matrix of cell areas for each region so that regional
+    area-weighted sums can be computed with a single matrix product.
+
+    Parameters
+    ----------
+    dsRegionMask : ``xarray.Dataset``
+        A region mask data set containing ``regionCellMasks``
+
+    areaCell : ``xarray.DataArray``
+        The area of each MPAS cell
+
+    openOceanMask : ``xarray.DataArray``, optional
+        A mask of cells outside of ice-shelf cavities.  If supplied, it is
+        applied to each region but not to the global domain.
+
+    Returns
+    -------
+    regionWeights : ``scipy.sparse.csr_matrix``
+        An (nRegions+1) x nCells matrix of cell areas, where the last row
+        corresponds to the global domain
+    """
+    cellMasks = dsRegionMask.regionCellMasks.transpose('nCells', 'nRegions')
+    cellMasks = cellMasks.values == 1
+    if openOceanMask is not None:
+        cellMasks = np.logical_and(cellMasks,
+                                   openOceanMask.values[:, np.newaxis])
+    nCells, nRegions = cellMasks.shape
+
+    cellIndices, regionIndices = np.nonzero(cellMasks)
+    # the global "region" includes all cells
+    rows = np.concatenate([regionIndices, nRegions*np.ones(nCells, dtype=int)])
+    columns = np.concatenate([cellIndices, np.arange(nCells)])
+    area = areaCell.values[columns]
+
+    return scipy.sparse.csr_matrix((area, (rows, columns)),
+                                   shape=(nRegions+1, nCells))
+
+
+def compute_regional_sums(regionWeights, field):
+    """
+    Compute area-weighted sums of a field over each region, one time slice at
+    a time.
+
+    Parameters
+    ----------
+    regionWeights : ``scipy.sparse.csr_matrix``
+        An nRegions x nCells matrix of weights, as returned by
+        ``compute_region_weights()``
+
+    field : numpy array
+        An nTime x nCells x nVertLevels array.  Invalid values (e.g. below
+        the bathymetry) should be NaN and are treated as zero.
+
+    Returns
+    -------
+    regionalSums : numpy array
+        An nRegions x nTime x nVertLevels array of weighted sums
+    """
+    nTime, nCells, nVertLevels = field.shape
+    regionalSums = np.zeros((regionWeights.shape[0], nTime, nVertLevels))
+    for iTime in range(nTime):
+        regionalSums[:, iTime, :] = \
+            regionWeights.dot(np.nan_to_num(field[iTime, :, :]))
+    return regionalSums
+
+
+def append_to_time_series_store(storeFile, dsYear, year, chunkMonths=120):
+    """
+    Append one year of regional time series to a consolidated netCDF store
+    with an unlimited ``Time`` dimension, creating the store if needed.
+
+    Variables with a ``Time`` dimension are chunked by region so that single
+    regions can be read efficiently.  The ``year`` of each new time entry is
+    written last, so entries from an interrupted append are not counted as
+    stored and are overwritten by the next append.
+
+    A year before the last stored year (extending a run backward or filling
+    a gap) is inserted by rewriting the store in ``year`` order.
+
+    Parameters
+    ----------
+    storeFile : str
+        The path to the consolidated store
+
+    dsYear : ``xarray.Dataset``
+        The time series for one year, with variables of dimension
+        ``nRegions`` x ``Time`` x ``nVertLevels`` and time-independent
+        variables (e.g. ``totalArea`` and ``refBottomDepth``)
+
+    year : int
+        The year of the time series in ``dsYear``
+
+    chunkMonths : int, optional
+        The chunk size along the ``Time`` dimension
+    """
+    if not os.path.exists(storeFile):
+        _create_time_series_store(storeFile, dsYear, chunkMonths)
+
+    with netCDF4.Dataset(storeFile, 'r') as store:
+        storedYears = np.ma.compressed(store.variables['year'][:])
+    if year in storedYears:
+        raise ValueError('Year {} is already in {}'.format(year, storeFile))
+    if len(storedYears) > 0 and year < storedYears[-1]:
+        _insert_into_time_series_store(storeFile, dsYear, year, chunkMonths)
+        return
+
+    with netCDF4.Dataset(storeFile, 'a') as store:
+        yearVar = store.variables['year']
+        start = np.ma.count(yearVar[:])
+        stop = start + dsYear.sizes['Time']
+
+        store.variables['Time'][start:stop] = dsYear.Time.values
+        for varName, var in dsYear.data_vars.items():
+            if 'Time' not in var.dims:
+                continue
+            index = tuple(slice(start, stop) if dim == 'Time' else slice(None)
+                          for dim in var.dims)
+            store.variables[varName][index] = var.values
+        yearVar[start:stop] = year
+
+
+def _insert_into_time_series_store(storeFile, dsYear, year, chunkMonths):
+    """
+    Insert one year before the last stored year by writing a new store with
+    all entries in ``year`` order and replacing the old store with it
+    """
+    with netCDF4.Dataset(storeFile, 'r') as store:
+        # only complete entries are kept (as in append_to_time_series_store,
+        # entries from an interrupted append have no year), so count them
+        # before turning off masking of fill values
+        count = np.ma.count(store.variables['year'][:])
+        store.set_auto_mask(False)
+        storedYears = store.variables['year'][0:count]
+        split = int(np.searchsorted(storedYears, year))
+        newValues = dict(dsYear.data_vars.items())
+        newValues['Time'] = dsYear.Time
+        newValues['year'] = np.full(dsYear.sizes['Time'], year, dtype='i4')
+        values = {}
+        for varName, var in store.variables.items():
+            if 'Time' not in var.dimensions:
+                continue
+            axis = var.dimensions.index('Time')
+            index = [slice(None)]*var.ndim
+            index[axis] = slice(0, count)
+            stored = var[tuple(index)]
+            values[varName] = np.concatenate(
+                (stored.take(np.arange(split), axis=axis),
+                 np.asarray(newValues[varName]),
+                 stored.take(np.arange(split, count), axis=axis)), axis=axis)
+
+    newStoreFile = '{}.insert{}'.format(storeFile, os.getpid())
+    _create_time_series_store(newStoreFile, dsYear, chunkMonths)
+    with netCDF4.Dataset(newStoreFile, 'a') as store:
+        for varName, value in values.items():
+            if varName != 'year':
+                store.variables[varName][:] = value
+        # as when appending, the years are written last
+        store.variables['year'][:] = values['year']
+    os.replace(newStoreFile, storeFile)
+
+
+def _create_time_series_store(storeFile, dsYear, chunkMonths):
+    """
+    Create an empty time series store with the variables and dimensions of
+    ``dsYear``, writing to a temporary file that is renamed once complete
+    """
+    tempFile = '{}.tmp{}'.format(storeFile, os.getpid())
+    with netCDF4.Dataset(tempFile, 'w', format='NETCDF4') as store:
+        for dim, size in dsYear.sizes.items():
+            store.createDimension(dim, None if dim == 'Time' else size)
+        timeVar = store.createVariable('Time', 'f8', ('Time',))
+        timeVar.setncatts({key: value for key, value
+                           in dsYear.Time.attrs.items()
+                           if key != '_FillValue'})
+        store.createVariable('year', 'i4', ('Time',),
+                             fill_value=netCDF4.default_fillvals['i4'])
+        for varName, var in dsYear.data_vars.items():
+            if 'Time' in var.dims:
+                chunksizes = [chunkMonths if dim == 'Time'
+                              else 1 if dim == 'nRegions' else dsYear.sizes[dim]
+                              for dim in var.dims]
+                storeVar = store.createVariable(varName, 'f8', var.dims,
+                                                chunksizes=chunksizes)
+            else:
+                storeVar = store.createVariable(varName, var.dtype, var.dims)
+                storeVar[:] = var.values
+            storeVar.setncatts({key: value for key, value in var.attrs.items()
+                                if key != '_FillValue'})
+    os.replace(tempFile, storeFile)
+
+
+def get_time_series_store_years(storeFile):
+    """
+    Returns a sorted array of the years stored in a time series store (empty
+    if the store does not exist)
+    """
+    if not os.path.exists(storeFile):
+        return np.array([], dtype=int)
+    with netCDF4.Dataset(storeFile, 'r') as store:
+        return np.unique(np.ma.compressed(store.variables['year'][:]))
+
+
+def open_time_series_store(storeFile, startYear=None, endYear=None):
+    """
+    Lazily open a time series store, keeping only completely written time
+    entries between ``startYear`` and ``endYear`` (inclusive)
+
+    Returns
+    -------
+    ds : ``xarray.Dataset``
+        The time series for all regions
+    """
+    ds = xr.open_dataset(storeFile, decode_times=False)
+    ds = ds.isel(Time=slice(0, int(ds.year.notnull().sum())))
+    year = ds.year.values
+    keep = np.ones(year.shape, bool)
+    if startYear is not None:
+        keep = np.logical_and(keep, year >= startYear)
+    if endYear is not None:
+        keep = np.logical_and(keep, year <= endYear)
+    return ds.isel(Time=keep)
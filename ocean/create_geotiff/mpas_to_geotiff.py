@@ -1,10 +1,15 @@
 import yaml
 import os
+import sys
 import pprint
 import numpy as np
 import gdal, osr
 from netCDF4 import Dataset
-from matplotlib.tri import Triangulation, LinearTriInterpolator
+from matplotlib.tri import LinearTriInterpolator
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'mesh_cache'))
+from mesh_cache import MeshCache
 
 #######################################################################
 #######################################################################
@@ -70,28 +75,9 @@ if __name__ == "__main__":
     var[var < 0.01] = np.nan
     print("Thin layers total of {:f} thickness.".format(thinlayers))
 
-  # Read data from mesh file
-  ncmesh = Dataset(cfg['mesh_file'],'r')
-  lon_mesh = np.rad2deg(np.mod(ncmesh.variables['lonCell'][:] + np.pi, 2.0*np.pi) - np.pi)
-  lat_mesh = np.rad2deg(ncmesh.variables['latCell'][:])
-  nEdgesOnCell = ncmesh.variables['nEdgesOnCell'][:]
-  cellsOnCell = ncmesh.variables['cellsOnCell'][:,:]
- 
-  # Triangulate cells 
-  triangles = Triangulation(lon_mesh,lat_mesh)
-
-  # Compute triangulation mask (needs to be vectorized)
-  mask = np.array(np.zeros((triangles.triangles.shape[0],)),dtype=bool)
-  ntri = triangles.neighbors.shape[0]
-  for i in range(ntri):
-    k = 0
-    for j in range(3):
-      n = triangles.triangles[i,j]
-      if nEdgesOnCell[n] != np.where(cellsOnCell[n,:] != 0)[0].size:  # Mask triangles
-        k = k +1                                                      # containing
-    if k == 3:                                                        # 3 boundary
-      mask[i] = True                                                  # cells
-  triangles.set_mask(mask)
+  # Triangulate cells, masking triangles containing 3 boundary cells
+  # (cached per mesh)
+  triangles = MeshCache(cfg['mesh_file']).triangulation()
 
   # Write out geotiff image
   output_name = cfg['output_variable']+'.tif'
@@ -3,40 +3,54 @@ Created Friday Dec 14 2018
 
 @author: Phillip J. Wolfram
 
-version: 1.0
+version: 1.1
+
+Changes in 1.1: when an eddy grows to fill its whole feature, the r2
+criterion is evaluated on the eddy itself.  Version 1.0 also counted cell
+(0, 0) in that case (the argmin of an empty neighbor mask), which almost
+always rejected such eddies, so 1.1 finds more eddies and eddy counts,
+labels and census statistics differ from 1.0 results.
 
 """
 
 # libraries
+import heapq
+import multiprocessing
 import numpy as np
-from scipy.ndimage import label
+from scipy.ndimage import label, find_objects, generate_binary_structure
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 import numpy.ma as ma
 import matplotlib.pyplot as plt
 
 
-def ow_eddy_labeled_mask(ow, owmin=-0.2, mineddycells=0):
+def ow_eddy_labeled_mask(ow, owmin=-0.2, mineddycells=0, connectivity=4):
     """
     Computes labels corresponding to unique areas of owmin
-    isosurfaces.
+    isosurfaces, connecting cells through their 4 (sides) or
+    8 (sides and corners) neighbors.
 
     Phillip J. Wolfram
     12/14/2018
     """
 
+    if connectivity not in (4, 8):
+        raise ValueError('connectivity must be 4 or 8, not {}'.format(
+            connectivity))
 
     # get discrete regions of eddy activity
     mask = (ow < owmin)
-    mask, nfeatures = label(mask)
+    structure = generate_binary_structure(
+        mask.ndim, 1 if connectivity == 4 else mask.ndim)
+    mask, nfeatures = label(mask, structure)
 
     # filter regions to ensure each is larger than
-    # mineddycells
+    # mineddycells, renumbering the remaining features in order
     if mineddycells > 0:
-        for ii in 1 + np.arange(nfeatures):
-            if np.sum(mask == ii) < mineddycells:
-                # remove the feature
-                mask[mask==ii] = 0
-
-        mask, nfeatures = label(mask > 0)
+        keep = np.bincount(mask.ravel(), minlength=nfeatures+1) >= mineddycells
+        keep[0] = False
+        mask = (np.cumsum(keep)*keep).astype(mask.dtype)[mask]
+        nfeatures = int(keep.sum())
 
     return mask, nfeatures
 
@@ -116,71 +130,315 @@ def r2check(ow, da, minr2points=50, plot=False):
         return np.corrcoef(ow, a)[0,1]**2.0
 
 
+class R2Accumulator(object):
+    """
+    Incremental r2 between OW values and the cumulative area of cells sorted
+    by OW value, as computed by r2check, from the running sums n, sum(x),
+    sum(y), sum(x^2), sum(y^2) and sum(xy).
+
+    Appending a cell with an OW value at least as large as all previous cells
+    is O(1); appending a smaller value shifts the cumulative areas of the p
+    cells after it, which is O(p).  The most recently appended cell can be
+    removed again with rollback.
+    """
+
+    def __init__(self, capacity=64):
+        self.n = 0
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.sumx = 0.
+        self.sumy = 0.
+        self.sumxx = 0.
+        self.sumyy = 0.
+        self.sumxy = 0.
+        self._last = None
+
+    def append(self, x, da):
+        """ Adds a cell with OW value x and area da """
+        n = self.n
+        if n == self.x.size:
+            self.x = np.concatenate((self.x, np.zeros(n)))
+            self.y = np.concatenate((self.y, np.zeros(n)))
+
+        if n == 0 or x >= self.x[n-1]:
+            p = n
+        else:
+            p = np.searchsorted(self.x[:n], x, side='right')
+
+        y = da
+        if p > 0:
+            y += self.y[p-1]
+
+        if p < n:
+            # all later cells have da more cumulative area
+            xafter = self.x[p:n]
+            yafter = self.y[p:n]
+            self.sumy += (n - p)*da
+            self.sumyy += 2.*da*yafter.sum() + (n - p)*da**2
+            self.sumxy += da*xafter.sum()
+            self.x[p+1:n+1] = xafter.copy()
+            self.y[p+1:n+1] = yafter + da
+
+        self.x[p] = x
+        self.y[p] = y
+        self._add_sums(x, y, 1.)
+        self.n = n + 1
+        self._last = (p, da)
+
+    def rollback(self):
+        """ Removes the most recently appended cell """
+        p, da = self._last
+        self._last = None
+        n = self.n - 1
+        self._add_sums(self.x[p], self.y[p], -1.)
+
+        if p < n:
+            xafter = self.x[p+1:n+1]
+            yafter = self.y[p+1:n+1]
+            self.sumy -= (n - p)*da
+            self.sumyy -= 2.*da*yafter.sum() - (n - p)*da**2
+            self.sumxy -= da*xafter.sum()
+            self.x[p:n] = xafter.copy()
+            self.y[p:n] = yafter - da
+        self.n = n
+
+    def _add_sums(self, x, y, sign):
+        self.sumx += sign*x
+        self.sumxx += sign*x**2
+        self.sumy += sign*y
+        self.sumyy += sign*y**2
+        self.sumxy += sign*x*y
+
+    def r2(self, minr2points=50):
+        """
+        Returns r2, always "succeeding" with 1.0 if there are fewer than
+        minr2points cells and giving nan if either variance vanishes
+        """
+        n = self.n
+        if n < minr2points:
+            return 1.0
+        covariance = n*self.sumxy - self.sumx*self.sumy
+        varx = n*self.sumxx - self.sumx**2
+        vary = n*self.sumyy - self.sumy**2
+        if not (varx > 0. and vary > 0.):
+            return np.nan
+        return min(covariance**2/(varx*vary), 1.0)
+
+
+def _grid_neighbors(nx, ny, connectivity=4):
+    """
+    Returns a function giving the flat indices of the up/down/left/right
+    neighbors of a flat index on an nx by ny grid (as in neighlist), and
+    of the diagonal neighbors as well if connectivity is 8.
+    """
+
+    def neighbors(cell):
+        i, j = divmod(cell, ny)
+        neighs = []
+        if j + 1 < ny:
+            neighs.append(cell + 1)
+        if j > 0:
+            neighs.append(cell - 1)
+        if i + 1 < nx:
+            neighs.append(cell + ny)
+        if i > 0:
+            neighs.append(cell - ny)
+        return neighs
+
+    def neighbors8(cell):
+        i, j = divmod(cell, ny)
+        neighs = neighbors(cell)
+        for di in (-1, 1):
+            if 0 <= i + di < nx:
+                for dj in (-1, 1):
+                    if 0 <= j + dj < ny:
+                        neighs.append(cell + di*ny + dj)
+        return neighs
+
+    if connectivity == 8:
+        return neighbors8
+    return neighbors
+
+
+def _grow_eddy(seed, available, owdata, owmask, da, neighbors, minr2points,
+               mineddycells, r2cond):
+    """
+    Grows an eddy from the seed cell, adding the available neighbor with the
+    smallest OW value (the smallest flat index among equal values) one at a
+    time while the r2 criterion holds.
+
+    available:      flat boolean array, True for cells of the feature that
+                    may be added
+    owdata, owmask: flat OW values and mask (masked cells are grown through
+                    but not used in the r2 criterion)
+    da:             flat cell area
+    neighbors:      function returning the flat indices of a cell's neighbors
+
+    Returns whether an eddy was found and the flat indices of its cells.
+    """
+    cells = [seed]
+    seen = set(cells)
+    frontier = []
+    r2acc = R2Accumulator()
+    if not owmask[seed]:
+        r2acc.append(owdata[seed], da[seed])
+
+    r2 = 1.0
+    while r2 > r2cond:
+        # the frontier holds the neighbors of the eddy that can be added
+        for neigh in neighbors(cells[-1]):
+            if available[neigh] and neigh not in seen:
+                seen.add(neigh)
+                heapq.heappush(frontier, (owdata[neigh], neigh))
+
+        # if there aren't any additional cells to test, return result
+        # (without adding a spurious cell, unlike version 1.0)
+        if len(frontier) == 0:
+            eddyfound = (r2 > r2cond and len(cells) >= mineddycells)
+            return eddyfound, np.array(cells)
+
+        # add the minimum of the neighbors to the eddy to build out
+        # increasing isosurfaces with paired areas
+        _, owmin = heapq.heappop(frontier)
+        cells.append(owmin)
+        if not owmask[owmin]:
+            r2acc.append(owdata[owmin], da[owmin])
+        r2 = r2acc.r2(minr2points)
+
+    # roll back including point that broke accuracy of estimate
+    cells = np.array(cells[:-1])
+    if not owmask[owmin]:
+        r2acc.rollback()
+
+    # if eddy is found record it
+    r2 = r2acc.r2(minr2points=-1)
+    eddyfound = (r2 > r2cond and len(cells) >= mineddycells)
+    return eddyfound, cells
+
+
 def find_eddy(feature, ow, da, minr2points=30, mineddycells=100, r2cond=0.9):
     """
     Returns a found eddyfeature provided it meets r2 criteria 
     based on a feature of a ow field with paired area da for a
     minimum r2 of r2cond requiring minr2points to make the comparison.
 
+    The eddy is grown from the minimum of ow in the feature by repeatedly
+    adding the neighboring cell with the smallest ow, kept in a heap, with
+    the r2 updated by an R2Accumulator.
+
     Phillip J. Wolfram
     12/14/2018
     
     """
 
-    # initialize empty eddy feature
-    eddyfeature = feature*False
-    foundeddy = False
+    owdata = ma.getdata(ow).ravel()
+    owmask = ma.getmaskarray(ow).ravel()
+    available = np.asarray(feature).ravel()
+    da = np.broadcast_to(da, feature.shape).ravel()
 
     # find staring minimum seed
-    owmin = get_min_id(ow, feature)
-    eddyfeature[owmin] = True
+    candidates = np.flatnonzero(available)
+    seed = candidates[np.argmin(owdata[candidates])]
 
-    # we will check the found min point and build list from there
-    # note that at some time in the code, here aren't enough points
-    # to assess whether there is an eddy
-    r2 = 1.0
-    while r2 > r2cond:
-        
-        # get neighboors to found point
-        neighs = neighlist(np.array(np.where(eddyfeature)).T, 
-                eddyfeature.shape[0]-1, eddyfeature.shape[1]-1)
-        
-        # clean up mask for testing, flagging neighbors 
-        # that aren't currently found min or out of feature
-        eddytest = feature*False
-        eddytest[neighs] = True
-        eddytest[eddyfeature] = False
-        eddytest[~feature] = False
-
-        # find minimum of neighs and add to eddy feature
-        owmin = get_min_id(ow, eddytest)
-        eddyfeature[owmin] = True
-        
-        r2 = r2check(ow[eddyfeature], da[eddyfeature], minr2points=minr2points)
-        
-        # thus, this consistently adds the minimum of the neighbor to the feature
-        # to build out increasing isosurfaces w and paired areas
-        
-        # if there aren't any additional eddies to test, return result
-        if np.sum(eddytest) == 0:
-            # print 'No neighbooring eddies that can be tested.'
-            eddyfound = (r2 > r2cond and np.sum(eddyfeature) >= mineddycells) 
-            return eddyfound, eddyfeature
-    
-    # roll back including point that broke accuracy of estimate
-    eddyfeature[owmin] = False
+    eddyfound, cells = _grow_eddy(seed, available, owdata, owmask, da,
+                                  _grid_neighbors(*feature.shape),
+                                  minr2points, mineddycells, r2cond)
 
-    # if eddy is found record it
-    r2 = r2check(ow[eddyfeature], da[eddyfeature], minr2points=-1)
-    eddyfound = (r2 > r2cond and np.sum(eddyfeature) >= mineddycells) 
+    eddyfeature = np.zeros(feature.shape, dtype=bool)
+    eddyfeature.flat[cells] = True
     return eddyfound, eddyfeature
 
 
-def find_all_eddies(ow, da, owmin=-0.2, mineddycells=100, minr2points=30, r2cond=0.9):
+def _csr_neighbors(adjacency):
+    """
+    Returns a function giving the indices of the neighbors of a cell from a
+    CSR adjacency matrix.
+    """
+    indptr = adjacency.indptr
+    indices = adjacency.indices
+
+    def neighbors(cell):
+        return indices[indptr[cell]:indptr[cell+1]]
+
+    return neighbors
+
+
+def _find_feature_eddies(args):
+    """
+    Finds all the eddies in a single feature, either cropped to its bounding
+    box on a grid (adjacency is None) or as the cells of the feature with
+    their CSR adjacency on a mesh.
+
+    Returns an integer array numbering the eddies of the feature from 1 (0
+    where no eddy was found), or None if there are none, and the number of
+    eddies.
+    """
+    (feature, ow, owmask, da, adjacency, connectivity, mineddycells,
+     minr2points, r2cond) = args
+
+    owdata = ow.ravel()
+    owmask = owmask.ravel()
+    da = da.ravel()
+    if adjacency is None:
+        neighbors = _grid_neighbors(*feature.shape,
+                                    connectivity=connectivity)
+    else:
+        neighbors = _csr_neighbors(adjacency)
+
+    # make sure there are values to compute
+    featurecells = np.flatnonzero(feature)
+    if owmask[featurecells].min():
+        # print 'Cannot analyze feature for eddies because it is masked.'
+        return None, 0
+
+    # the cells of the feature sorted by ow (and flat index for ties), so
+    # the seed of each eddy is the first cell still available
+    featurecells = featurecells[np.lexsort((featurecells,
+                                            owdata[featurecells]))]
+
+    # iterate on feature until all possible eddies 
+    # (taking minpoint cells at a time are found)
+    neddies = 0
+    eddies = np.zeros(feature.size, dtype='i')
+    available = feature.ravel().copy()
+    remaining = len(featurecells)
+    first = 0
+    while remaining > 0:
+        while not available[featurecells[first]]:
+            first += 1
+        foundeddy, eddycells = _grow_eddy(
+            featurecells[first], available, owdata, owmask, da,
+            neighbors, minr2points, mineddycells, r2cond)
+
+        if foundeddy:
+            # store eddy information
+            neddies += 1
+            # print('Found eddy {:d}'.format(neddies))
+            eddies[eddycells] = neddies
+
+        # remove eddy information from feature
+        available[eddycells] = False
+        remaining -= len(eddycells)
+        # print('{:d} points left in feature'.format(remaining))
+        if remaining < minr2points:
+            # terminate check because there aren't enough points to assess
+            break
+
+    if neddies == 0:
+        return None, 0
+    return eddies.reshape(feature.shape), neddies
+
+
+def find_all_eddies(ow, da, owmin=-0.2, mineddycells=100, minr2points=30, r2cond=0.9,
+                    workers=1, connectivity=4):
     """
     Finds all the eddies in the dataset and places them in a mask where an integer
     labels the eddy number.
 
+    Each feature is cropped to its bounding box and searched for eddies on
+    its own, in a pool of worker processes if workers > 1.  Eddies are
+    numbered in feature order either way.
+
     inputs
     ------
     ow:             Okubo Weiss array
@@ -189,6 +447,10 @@ def find_all_eddies(ow, da, owmin=-0.2, mineddycells=100, minr2points=30, r2cond
     mineddycells:   minimum number of cells to be considered an eddy
     minr2points:    minimum number of points to be used to assess r2 criterion
     r2cond:         minimum acceptable r2 to be considered an eddy
+    workers:        number of processes searching features in parallel
+    connectivity:   4 to connect cells through their sides only, 8 to also
+                    connect them through their corners, both for features
+                    and for growing eddies
 
     outputs
     -------
@@ -200,45 +462,270 @@ def find_all_eddies(ow, da, owmin=-0.2, mineddycells=100, minr2points=30, r2cond
     """
 
     # get the overall eddy mask
-    mask, nfeatures = ow_eddy_labeled_mask(ow, owmin, mineddycells)
+    mask, nfeatures = ow_eddy_labeled_mask(ow, owmin, mineddycells,
+                                           connectivity)
 
+    owdata = ma.getdata(ow)
+    owmask = ma.getmaskarray(ow)
+    da = np.broadcast_to(da, mask.shape)
+    featureslices = find_objects(mask)
+
+    # crop each of the large features to find the eddies
+    features = ((mask[sl] == afeature, owdata[sl], owmask[sl], da[sl], None,
+                 connectivity, mineddycells, minr2points, r2cond)
+                for afeature, sl in enumerate(featureslices, start=1))
 
-    # loop over each of the large features to find the eddies
-    neddies = 0
     alleddies = np.zeros_like(mask)
-    for afeature in 1 + np.arange(nfeatures):
-        # print('On feature {:d} of {:d}'.format(afeature, nfeatures))
+    _stitch_eddies(alleddies, featureslices, features, nfeatures, workers)
+
+    return alleddies
 
-        # iterate on feature until all possible eddies 
-        # (taking minpoint cells at a time are found)
-        feature = (mask == afeature)
 
-        # make sure there are values to compute
-        if ow.mask[feature].min():
-            # print 'Cannot analyze feature for eddies because it is masked.'
-            continue
-        
-        # find the eddies if there are values to compute
-        while np.sum(feature) > 0:
-            foundeddy, eddyfeature = find_eddy(feature, ow, da, 
-                                               minr2points, mineddycells, r2cond)
-
-            if foundeddy:
-                # store eddy information
-                neddies += 1
-                # print('Found eddy {:d}'.format(neddies))
-                alleddies[eddyfeature] = neddies
-
-            # remove eddy information from feature
-            feature[eddyfeature] = False
-            # print('{:d} points left in feature'.format(feature.sum()))
-            if np.sum(feature) < minr2points:
-                # terminate check because there aren't enough points to assess
-                feature = False
+def _stitch_eddies(alleddies, regions, features, nfeatures, workers):
+    """
+    Searches the features for eddies (in a pool of worker processes if
+    workers > 1) and stores them in the regions of alleddies, numbered in
+    feature order.
+    """
+
+    if workers > 1:
+        # workers are forked, as elsewhere in these scripts
+        pool = multiprocessing.get_context('fork').Pool(processes=workers)
+        chunksize = max(1, nfeatures // (4*workers))
+        results = pool.imap(_find_feature_eddies, features, chunksize)
+    else:
+        pool = None
+        results = map(_find_feature_eddies, features)
+
+    neddies = 0
+    try:
+        for region, (eddies, count) in zip(regions, results):
+            if count > 0:
+                found = eddies > 0
+                regioneddies = alleddies[region]
+                regioneddies[found] = eddies[found] + neddies
+                alleddies[region] = regioneddies
+                neddies += count
+    except BaseException:
+        # don't wait for queued work if a worker failed or we were interrupted
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return neddies
+
+
+def cell_adjacency(cellsOnCell, nEdgesOnCell):
+    """
+    Returns the adjacency of MPAS cells as an nCells by nCells boolean CSR
+    matrix, from cellsOnCell (1-based, 0 where there is no neighbor) and
+    nEdgesOnCell.
+    """
+    cellsOnCell = np.asarray(cellsOnCell)
+    nCells, maxEdges = cellsOnCell.shape
+
+    valid = ((np.arange(maxEdges) < np.asarray(nEdgesOnCell)[:, np.newaxis]) &
+             (cellsOnCell > 0) & (cellsOnCell <= nCells))
+    counts = valid.sum(axis=1)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    indices = cellsOnCell[valid] - 1
+
+    return csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                      shape=(nCells, nCells))
+
+
+def ow_eddy_labeled_cells(ow, adjacency, owmin=-0.2, mineddycells=0):
+    """
+    Computes labels corresponding to unique areas of owmin
+    isosurfaces on an MPAS mesh, as ow_eddy_labeled_mask does on
+    a grid.  Features are numbered in order of their lowest cell index.
+
+    ow:        Okubo Weiss on cells
+    adjacency: CSR cell adjacency from cell_adjacency
+    """
+
+    # get discrete regions of eddy activity
+    mask = np.asarray(ow < owmin)
+    cells = np.flatnonzero(mask)
+    local = np.full(mask.size, -1)
+    local[cells] = np.arange(len(cells))
+    nfeatures, featurelabels = connected_components(
+        _feature_adjacency(adjacency, cells, local), directed=False)
+
+    # filter regions to ensure each is larger than
+    # mineddycells
+    keep = np.bincount(featurelabels, minlength=nfeatures) >= mineddycells
+    newlabels = np.cumsum(keep)*keep
+    nfeatures = int(keep.sum())
+
+    labels = np.zeros(mask.size, dtype='i')
+    labels[cells] = newlabels[featurelabels]
+
+    return labels, nfeatures
+
+
+def _feature_adjacency(adjacency, cells, local):
+    """
+    Returns the CSR adjacency between the given cells, renumbered in the
+    order of cells, where local maps every cell index to its position in
+    cells (or -1).
+    """
+    rows = adjacency[cells]
+    cols = local[rows.indices]
+    keep = cols >= 0
+    rowids = np.repeat(np.arange(len(cells)), np.diff(rows.indptr))
+    counts = np.bincount(rowids[keep], minlength=len(cells))
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+
+    return csr_matrix((np.ones(keep.sum(), dtype=bool), cols[keep], indptr),
+                      shape=(len(cells), len(cells)))
+
+
+def find_all_eddies_mesh(ow, da, cellsOnCell, nEdgesOnCell, owmin=-0.2,
+                         mineddycells=100, minr2points=30, r2cond=0.9,
+                         workers=1):
+    """
+    Finds all the eddies on the cells of an MPAS mesh, without remapping to a
+    grid, and places them in an array where an integer labels the eddy number.
+    Eddies grow across cellsOnCell neighbors with the same criteria as
+    find_all_eddies.
+
+    inputs
+    ------
+    ow:             Okubo Weiss on cells
+    da:             cell area (areaCell)
+    cellsOnCell:    MPAS cellsOnCell (1-based, 0 where there is no neighbor)
+    nEdgesOnCell:   MPAS nEdgesOnCell
+    owmin:          minimum Okubo Weiss threshold
+    mineddycells:   minimum number of cells to be considered an eddy
+    minr2points:    minimum number of points to be used to assess r2 criterion
+    r2cond:         minimum acceptable r2 to be considered an eddy
+    workers:        number of processes searching features in parallel
+
+    outputs
+    -------
+    alleddies:      an integer array over cells numbering eddy label
+                    corresponding to each eddy found.  0 indicates no eddy
+                    was found.
+    """
+
+    adjacency = cell_adjacency(cellsOnCell, nEdgesOnCell)
+    labels, nfeatures = ow_eddy_labeled_cells(ow, adjacency, owmin,
+                                              mineddycells)
+
+    owdata = ma.getdata(ow)
+    owmask = ma.getmaskarray(ow)
+    da = np.broadcast_to(da, labels.shape)
+
+    # cells of each feature in increasing cell order
+    order = np.argsort(labels, kind='stable')
+    offsets = np.cumsum(np.bincount(labels, minlength=nfeatures+1))
+    featurecells = [order[offsets[afeature-1]:offsets[afeature]]
+                    for afeature in 1 + np.arange(nfeatures)]
+
+    local = np.full(labels.size, -1)
+
+    def features():
+        for cells in featurecells:
+            local[cells] = np.arange(len(cells))
+            subadjacency = _feature_adjacency(adjacency, cells, local)
+            local[cells] = -1
+            yield (np.ones(len(cells), dtype=bool), owdata[cells],
+                   owmask[cells], da[cells], subadjacency, None,
+                   mineddycells, minr2points, r2cond)
+
+    alleddies = np.zeros(labels.shape, dtype='i')
+    _stitch_eddies(alleddies, featurecells, features(), nfeatures, workers)
 
     return alleddies
 
 
+def _label_argmin(labels, data, nlabels):
+    """
+    Returns the flat index of the minimum of data for each label 1..nlabels
+    (the first in flat order among equal values) in one sort of the labeled
+    cells, or -1 for labels without any cells.
+    """
+    labels = labels.ravel()
+    data = data.ravel()
+    cells = np.flatnonzero(labels)
+    order = cells[np.lexsort((data[cells], labels[cells]))]
+    counts = np.bincount(labels[cells], minlength=nlabels+1)[1:]
+    first = np.cumsum(counts) - counts
+    argmin = np.full(nlabels, -1, dtype=int)
+    present = counts > 0
+    argmin[present] = order[first[present]]
+    return argmin
+
+
+def eddy_statistics(alleddies, ow, da):
+    """
+    Computes statistics of every eddy in an alleddy index array with labeled
+    reductions, in one pass over the grid (or mesh cells).
+
+    inputs
+    ------
+    alleddies:      an integer array numbering eddy label corresponding to each
+                    eddy found.  0 indicates no eddy was found.
+    ow:             Okubo Weiss array
+    da:             cell area array
+
+    outputs
+    -------
+    stats:          dictionary of arrays with one entry per eddy (eddy label
+                    minus 1).  Labels need not be contiguous; labels
+                    without cells get a center and bbox of -1 and NaN
+                    owmin, owmean and centroid.
+                    center:   flat index of the OW minimum (as eddy_centers)
+                    owmin:    OW at the center
+                    owmean:   mean of unmasked OW
+                    area:     sum of da
+                    ncells:   number of cells
+                    centroid: area weighted centroid in index coordinates
+                              (neddies x ndim)
+                    bbox:     bounding box in index coordinates
+                              (neddies x ndim x [start, stop))
+    """
+
+    neddies = int(alleddies.max()) if alleddies.size > 0 else 0
+    labels = alleddies.ravel()
+    owdata = ma.getdata(ow).ravel()
+    owmask = ma.getmaskarray(ow).ravel()
+    da = np.broadcast_to(da, alleddies.shape).ravel()
+
+    def labeled_sum(weights):
+        return np.bincount(labels, weights=weights, minlength=neddies+1)[1:]
+
+    center = _label_argmin(labels, owdata, neddies)
+    area = labeled_sum(da)
+    ncells = np.bincount(labels, minlength=neddies+1)[1:]
+    nvalid = labeled_sum(~owmask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        owmean = labeled_sum(np.where(owmask, 0., owdata))/nvalid
+
+        coords = np.indices(alleddies.shape).reshape(alleddies.ndim, -1)
+        centroid = np.column_stack([labeled_sum(da*coord)/area
+                                    for coord in coords])
+
+    owmin = np.full(neddies, np.nan)
+    present = center >= 0
+    owmin[present] = owdata[center[present]]
+
+    bbox = np.full((neddies, alleddies.ndim, 2), -1, dtype=int)
+    for ieddy, slices in enumerate(find_objects(alleddies, neddies)):
+        if slices is not None:
+            bbox[ieddy] = [(sl.start, sl.stop) for sl in slices]
+
+    return {'center': center, 'owmin': owmin, 'owmean': owmean,
+            'area': area, 'ncells': ncells, 'centroid': centroid,
+            'bbox': bbox}
+
+
 def eddy_centers(alleddies, ow):
     """
     Find the eddy centers for an alleddy index array.
@@ -260,12 +747,13 @@ def eddy_centers(alleddies, ow):
 
     eddycenter = np.zeros_like(alleddies)
 
-    # for each eddy
-    for aeddy in 1 + np.arange(alleddies.max()):
-        # find minimum index for eddy
-        owmin = get_min_id(ow, (aeddy == alleddies))
-        # mark eddy center
-        eddycenter[owmin] = aeddy
+    # find minimum index for each eddy in one pass
+    neddies = int(alleddies.max()) if alleddies.size > 0 else 0
+    owmin = _label_argmin(alleddies, ma.getdata(ow), neddies)
+
+    # mark eddy centers (of the labels that have cells)
+    present = owmin >= 0
+    eddycenter.flat[owmin[present]] = 1 + np.flatnonzero(present)
 
     return eddycenter
 
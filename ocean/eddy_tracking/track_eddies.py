@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Name: track_eddies.py
+
+Detects Okubo-Weiss eddies on the native MPAS mesh for every time step of a
+set of history files and links them into tracks.
+
+Eddies are found with r2_detect_eddy.find_all_eddies_mesh, one time step per
+worker process.  The center of an eddy is its OW minimum; each center is
+linked to the nearest center of the previous time step (within
+--max_distance km) with a KD-tree, the closest eddy keeping the track when
+several claim the same one.
+
+The track table written to the output netCDF file has one row per eddy and
+time step (dimension nEddies) with the columns eddyID, timeIndex, time,
+lonCenter, latCenter, area and owMin.
+
+Example call:
+  ./track_eddies.py
+  -m MPAS_mesh.nc
+  -f 'RUN_PATH/analysis_members/okuboWeiss.*.nc'
+  -v okuboWeiss -l 0 -w 8
+  -o eddy_tracks.nc
+"""
+
+import glob
+import multiprocessing
+import os
+import sys
+import numpy as np
+from netCDF4 import Dataset
+from scipy.spatial import cKDTree
+
+import r2_detect_eddy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'mesh_cache'))
+from mesh_cache import MeshCache
+
+earthRadius = 6371.0e3 # m
+
+# mesh fields shared with (forked) worker processes
+mesh = {}
+
+
+def stream_ow(fileList, varName, level, timeVarName):
+    """
+    Yields the time and the OW field on cells (at vertical index level, if
+    the variable has a vertical dimension) for each time step of the files.
+    The time is read from timeVarName if present, otherwise it is the index
+    of the time step.
+    """
+    timeIndex = 0
+    for fname in fileList:
+        with Dataset(fname, 'r') as ncid:
+            var = ncid.variables[varName]
+            if timeVarName in ncid.variables:
+                times = ncid.variables[timeVarName][:]
+            else:
+                times = timeIndex + np.arange(var.shape[0])
+            for itime in range(var.shape[0]):
+                if var.ndim == 3:
+                    ow = var[itime, :, level]
+                else:
+                    ow = var[itime, :]
+                yield float(times[itime]), ow
+                timeIndex += 1
+
+
+def detect_eddies(ow, options):
+    """
+    Returns the center cell, area and OW minimum of each eddy found in one
+    OW field.
+    """
+    alleddies = r2_detect_eddy.find_all_eddies_mesh(
+        ow, mesh['areaCell'], mesh['cellsOnCell'], mesh['nEdgesOnCell'],
+        **options)
+
+    stats = r2_detect_eddy.eddy_statistics(alleddies, ow, mesh['areaCell'])
+
+    return stats['center'], stats['area'], stats['owmin']
+
+
+def _detect_step(args):
+    time, ow, options = args
+    return (time,) + detect_eddies(ow, options)
+
+
+def unit_vectors(lat, lon):
+    """Returns unit vectors on the sphere for lat/lon in degrees"""
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    return np.column_stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon),
+                            np.sin(lat)))
+
+
+def link_eddies(previousPoints, previousIDs, points, maxDistance, nextID):
+    """
+    Assigns track IDs to eddies from the nearest eddy of the previous time
+    step within maxDistance (m).  When several eddies are nearest to the same
+    previous eddy, the closest continues the track and the others start new
+    tracks.  Returns the IDs and the next unused ID.
+    """
+    ids = np.full(len(points), -1, dtype='i')
+    if len(previousPoints) > 0 and len(points) > 0:
+        # chord length on the unit sphere of the great circle maxDistance
+        maxChord = 2.*np.sin(0.5*maxDistance/earthRadius)
+        dist, nearest = cKDTree(previousPoints).query(
+            points, distance_upper_bound=maxChord)
+        matched = np.flatnonzero(np.isfinite(dist))
+
+        # the closest eddy claiming each previous eddy keeps its ID
+        order = matched[np.lexsort((dist[matched], nearest[matched]))]
+        _, first = np.unique(nearest[order], return_index=True)
+        winners = order[first]
+        ids[winners] = previousIDs[nearest[winners]]
+
+    new = ids < 0
+    ids[new] = nextID + np.arange(new.sum())
+    return ids, nextID + int(new.sum())
+
+
+def write_tracks(output, tracks):
+    """Writes the eddy track table to a netCDF file"""
+    columns = {key: np.concatenate([step[key] for step in tracks])
+               if len(tracks) > 0 else np.zeros(0)
+               for key in ['eddyID', 'timeIndex', 'time', 'lonCenter',
+                           'latCenter', 'area', 'owMin']}
+
+    ncid = Dataset(output, mode='w', clobber=True, format='NETCDF4')
+    ncid.createDimension('nEddies', len(columns['eddyID']))
+    for key, dtype, units in [('eddyID', 'i4', None),
+                              ('timeIndex', 'i4', None),
+                              ('time', 'f8', None),
+                              ('lonCenter', 'f8', 'degrees_east'),
+                              ('latCenter', 'f8', 'degrees_north'),
+                              ('area', 'f8', 'm^2'),
+                              ('owMin', 'f8', 's^-2')]:
+        var = ncid.createVariable(key, dtype, ('nEddies',), zlib=True)
+        if units is not None:
+            var.units = units
+        var[:] = columns[key]
+    ncid.close()
+
+
+def track_eddies(meshFile, filePattern, varName, level, timeVarName, output,
+                 maxDistance, workers, options):
+    meshCache = MeshCache(meshFile)
+    mesh['areaCell'] = meshCache.area_cell()
+    mesh['cellsOnCell'] = meshCache.get(
+        'cellsOnCell', lambda: meshCache.read_variable('cellsOnCell'))
+    mesh['nEdgesOnCell'] = meshCache.get(
+        'nEdgesOnCell', lambda: meshCache.read_variable('nEdgesOnCell'))
+    latCell, lonCell = meshCache.lat_lon_cell_degrees()
+
+    fileList = sorted(glob.glob(filePattern))
+    if len(fileList) == 0:
+        raise IOError('No files found matching {}'.format(filePattern))
+
+    steps = ((time, ow, options) for time, ow in
+             stream_ow(fileList, varName, level, timeVarName))
+    if workers > 1:
+        # workers are forked so they inherit the mesh
+        pool = multiprocessing.get_context('fork').Pool(processes=workers)
+        results = pool.imap(_detect_step, steps)
+    else:
+        pool = None
+        results = map(_detect_step, steps)
+
+    tracks = []
+    previousPoints = np.zeros((0, 3))
+    previousIDs = np.zeros(0, dtype='i')
+    nextID = 0
+    try:
+        for timeIndex, (time, centers, area, owMin) in enumerate(results):
+            points = unit_vectors(latCell[centers], lonCell[centers])
+            ids, nextID = link_eddies(previousPoints, previousIDs, points,
+                                      maxDistance, nextID)
+            print('Time step {:d}: {:d} eddies'.format(timeIndex, len(ids)))
+            tracks.append({'eddyID': ids,
+                           'timeIndex': np.full(len(ids), timeIndex),
+                           'time': np.full(len(ids), time),
+                           'lonCenter': lonCell[centers],
+                           'latCenter': latCell[centers],
+                           'area': area,
+                           'owMin': owMin})
+            previousPoints, previousIDs = points, ids
+    except BaseException:
+        # don't wait for queued work if a worker failed or we were interrupted
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    write_tracks(output, tracks)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-m", "--mesh_file", dest="mesh_filename",
+                        help="MPAS Mesh filename.", required=True)
+    parser.add_argument("-f", "--file_pattern", dest="file_pattern",
+                        help="MPAS Filename pattern for history files with OW.",
+                        metavar="FILE", required=True)
+    parser.add_argument("-v", "--variable", dest="variable",
+                        default="okuboWeiss",
+                        help="Name of the Okubo-Weiss variable.")
+    parser.add_argument("-l", "--level", dest="level", type=int, default=0,
+                        help="Vertical index of OW if it is 3D.")
+    parser.add_argument("--time_variable", dest="time_variable",
+                        default="daysSinceStartOfSim",
+                        help="Name of the time variable (the time step index "
+                             "is used if it is missing).")
+    parser.add_argument("-o", "--output_file", dest="output_filename",
+                        default="eddy_tracks.nc",
+                        help="Output netCDF file with the eddy track table.")
+    parser.add_argument("-d", "--max_distance", dest="max_distance",
+                        type=float, default=50.,
+                        help="Maximum distance (km) an eddy center may move "
+                             "between time steps and stay on its track.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=1,
+                        help="Number of processes detecting eddies.")
+    parser.add_argument("--owmin", dest="owmin", type=float, default=-0.2,
+                        help="Minimum Okubo-Weiss threshold.")
+    parser.add_argument("--mineddycells", dest="mineddycells", type=int,
+                        default=100,
+                        help="Minimum number of cells in an eddy.")
+    parser.add_argument("--minr2points", dest="minr2points", type=int,
+                        default=30,
+                        help="Minimum number of points to assess r2.")
+    parser.add_argument("--r2cond", dest="r2cond", type=float, default=0.9,
+                        help="Minimum acceptable r2 for an eddy.")
+    args = parser.parse_args()
+
+    track_eddies(meshFile=args.mesh_filename, filePattern=args.file_pattern,
+                 varName=args.variable, level=args.level,
+                 timeVarName=args.time_variable, output=args.output_filename,
+                 maxDistance=1e3*args.max_distance, workers=args.workers,
+                 options={'owmin': args.owmin,
+                          'mineddycells': args.mineddycells,
+                          'minr2points': args.minr2points,
+                          'r2cond': args.r2cond})
@@ -0,0 +1,166 @@
+"""
+A cache of derived MPAS mesh geometry shared by the ocean analysis scripts.
+
+Derived arrays (depth masks, coordinates in degrees, reference layer
+thicknesses, triangulations, cell areas) are computed once per mesh and
+stored as ``.npy`` files in a directory keyed by a fingerprint of the mesh
+file.  Later runs load them memory-mapped instead of re-reading the mesh
+and recomputing them.
+
+Example:
+    meshCache = MeshCache('ocean.EC30to60E2r2.200908.nc')
+    lat, lon = meshCache.lat_lon_cell_degrees()
+    depthMask = meshCache.depth_mask()
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import os
+import hashlib
+import numpy as np
+from netCDF4 import Dataset
+
+
+def mesh_file_hash(fileName, blockSize=2**20):
+    """
+    Returns a fingerprint of a mesh file computed from its size, its
+    modification time and its first and last ``blockSize`` bytes, which is
+    cheap even for very large meshes.
+
+    The bytes alone are not enough: a file regenerated in place often keeps
+    its size, header and trailing blocks while the arrays in between change,
+    so the modification time is included to catch that.  Copying or touching
+    the file also changes the fingerprint, which only costs recomputing the
+    cached arrays.
+    """
+    fileStat = os.stat(fileName)
+    fileSize = fileStat.st_size
+    sha = hashlib.sha1('{}_{}'.format(fileSize,
+                                      fileStat.st_mtime_ns).encode('utf-8'))
+    with open(fileName, 'rb') as meshFile:
+        sha.update(meshFile.read(blockSize))
+        meshFile.seek(max(fileSize - blockSize, 0))
+        sha.update(meshFile.read(blockSize))
+    return sha.hexdigest()
+
+
+class MeshCache(object):
+    """
+    Serves derived geometry for one MPAS mesh file from a persistent cache of
+    memory-mappable ``.npy`` files, computing and storing each array the first
+    time it is requested.
+    """
+
+    def __init__(self, meshFileName, cacheDirectory=None):
+        """
+        Parameters
+        ----------
+        meshFileName : str
+            An MPAS mesh, initial condition or restart file
+
+        cacheDirectory : str, optional
+            The base directory of the cache.  By default, the
+            ``MPAS_MESH_CACHE_DIR`` environment variable or
+            ``~/.cache/mpas_mesh_cache`` is used.
+        """
+        if not os.path.exists(meshFileName):
+            raise IOError('No MPAS mesh file found: {}'.format(meshFileName))
+        if cacheDirectory is None:
+            cacheDirectory = os.environ.get(
+                'MPAS_MESH_CACHE_DIR',
+                os.path.join(os.path.expanduser('~'), '.cache',
+                             'mpas_mesh_cache'))
+
+        self.meshFileName = meshFileName
+        meshName = os.path.splitext(os.path.basename(meshFileName))[0]
+        self.directory = os.path.join(cacheDirectory, '{}_{}'.format(
+            meshName, mesh_file_hash(meshFileName)[0:16]))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, name, compute):
+        """
+        Returns the cached array ``name`` as a read-only memory map, first
+        calling ``compute()`` to create and store it if it is not yet in the
+        cache.
+        """
+        fileName = os.path.join(self.directory, '{}.npy'.format(name))
+        if not os.path.exists(fileName):
+            # write to a temporary file so concurrent scripts never load a
+            # partially written array
+            tempFileName = os.path.join(self.directory, '{}.tmp{}.npy'.format(
+                name, os.getpid()))
+            np.save(tempFileName, np.ascontiguousarray(compute()))
+            os.replace(tempFileName, fileName)
+        return np.load(fileName, mmap_mode='r')
+
+    def read_variable(self, varName):
+        """
+        Reads a variable from the mesh file (the first time slice if the
+        variable has a ``Time`` dimension)
+        """
+        with Dataset(self.meshFileName, 'r') as ncfile:
+            var = ncfile.variables[varName]
+            var.set_auto_mask(False)
+            if len(var.dimensions) > 0 and var.dimensions[0] == 'Time':
+                return var[0, ...]
+            return var[...]
+
+    def lat_lon_cell_degrees(self):
+        """Returns latCell and lonCell in degrees"""
+        lat = self.get('latCellDegrees',
+                       lambda: np.rad2deg(self.read_variable('latCell')))
+        lon = self.get('lonCellDegrees',
+                       lambda: np.rad2deg(self.read_variable('lonCell')))
+        return lat, lon
+
+    def area_cell(self):
+        """Returns the area of each cell"""
+        return self.get('areaCell', lambda: self.read_variable('areaCell'))
+
+    def depth_mask(self):
+        """
+        Returns an nCells x nVertLevels mask that is ``True`` for valid
+        (above the bathymetry) layers
+        """
+        def compute():
+            maxLevelCell = self.read_variable('maxLevelCell')
+            nVertLevels = self.read_variable('refBottomDepth').size
+            return np.arange(nVertLevels)[np.newaxis, :] < \
+                maxLevelCell[:, np.newaxis]
+
+        return self.get('depthMask', compute)
+
+    def ref_layer_thickness(self):
+        """Returns the reference layer thickness computed from refBottomDepth"""
+        def compute():
+            refBottomDepth = self.read_variable('refBottomDepth')
+            return np.diff(refBottomDepth, prepend=0.)
+
+        return self.get('refLayerThickness', compute)
+
+    def triangulation(self):
+        """
+        Returns a ``matplotlib.tri.Triangulation`` of cell centers in lon/lat
+        (with longitude in [-180, 180)), masking triangles made up of 3
+        boundary cells
+        """
+        from matplotlib.tri import Triangulation
+
+        lat, lon = self.lat_lon_cell_degrees()
+        lon = self.get('lonCellDegreesPeriodic',
+                       lambda: np.mod(lon + 180., 360.) - 180.)
+
+        def compute_triangles():
+            return Triangulation(lon, lat).triangles
+
+        triangles = self.get('triangles', compute_triangles)
+
+        def compute_mask():
+            nEdgesOnCell = self.read_variable('nEdgesOnCell')
+            cellsOnCell = self.read_variable('cellsOnCell')
+            boundaryCell = nEdgesOnCell != np.sum(cellsOnCell != 0, axis=1)
+            return np.all(boundaryCell[triangles], axis=1)
+
+        mask = self.get('triangleMask', compute_mask)
+
+        return Triangulation(lon, lat, triangles=triangles, mask=mask)
@@ -24,8 +24,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 import xarray as xr
 from netCDF4 import Dataset
+from scipy import sparse
 import glob
 import platform
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'mesh_cache'))
+from mesh_cache import MeshCache
 
 m3ps_to_Sv = 1e-6 # m^3/sec flux to Sverdrups
 
@@ -37,6 +44,7 @@ def get_mask_short_names(mask):
   return mask
 
 def compute_transport(timeavg, mesh, mask, name='Drake Passage',output='transport.nc'):
+  meshCache = MeshCache(mesh)
   mesh = xr.open_dataset(mesh)
   mask = get_mask_short_names(xr.open_dataset(mask))
 
@@ -56,12 +64,7 @@ def compute_transport(timeavg, mesh, mask, name='Drake Passage',output='transpor
 # create empty t list for time
   t = []
 # Compute refLayerThickness to avoid need for hist file
-  refBottom = mesh.refBottomDepth.values
-  nz = mesh.dims['nVertLevels']
-  h = np.zeros(nz)
-  h[0] = refBottom[0]
-  for i in range(1,nz):
-    h[i] = refBottom[i] - refBottom[i-1]
+  h = meshCache.ref_layer_thickness()
 
 # Get a list of edges and total edges in each transect
   nEdgesInTransect = np.zeros(nTransects)
@@ -87,32 +90,43 @@ def compute_transport(timeavg, mesh, mask, name='Drake Passage',output='transpor
 
   edgesToRead = np.asarray(edgesToRead, dtype='i')
   dvEdge = mesh.dvEdge.sel(nEdges=edgesToRead).values
-  edgeSigns = np.zeros((nTransects,len(edgesToRead)))
-  for i in range(nTransects):
-    edgeSigns[i,:] = mask.sel(nEdges=edgesToRead, shortNames=transectList[i]).squeeze().transectEdgeMaskSigns.values
+
+# Build a sparse (transect x edge) matrix of signed dvEdge over the unique
+# edges of all transects, so transport for every transect and level is a
+# single product with the (edge, level) velocity
+  uniqueEdges, edgeIndices = np.unique(edgesToRead, return_inverse=True)
+  rows = np.zeros(len(edgesToRead), dtype='i')
+  weights = np.zeros(len(edgesToRead))
+  for j in range(nTransects):
+    start = int(nTransectStartStop[j])
+    stop = int(nTransectStartStop[j+1])
+    rows[start:stop] = j
+    edgeSigns = mask.sel(nEdges=edgesToRead[start:stop], shortNames=transectList[j]).squeeze().transectEdgeMaskSigns.values
+    weights[start:stop] = dvEdge[start:stop]*edgeSigns
+  transectWeights = sparse.csr_matrix((weights, (rows, edgeIndices)),
+                                      shape=(nTransects, len(uniqueEdges)))
 
 # Read time average files one at a time and slice
   fileList = sorted(glob.glob(timeavg))
-  transport = np.zeros((len(fileList),nTransects))
+  nVertLevels = len(h)
+  transportProfile = np.zeros((len(fileList),nTransects,nVertLevels))
   t = np.zeros(len(fileList))
   for i,fname in enumerate(fileList):
     ncid = Dataset(fname,'r')
     if 'timeMonthly_avg_normalTransportVelocity' in ncid.variables.keys():
-      vel = ncid.variables['timeMonthly_avg_normalTransportVelocity'][0,edgesToRead,:]
+      vel = ncid.variables['timeMonthly_avg_normalTransportVelocity'][0,uniqueEdges,:]
     elif 'timeMonthly_avg_normalVelocity' in ncid.variables.keys():
-      vel = ncid.variables['timeMonthly_avg_normalVelocity'][0,edgesToRead,:]
+      vel = ncid.variables['timeMonthly_avg_normalVelocity'][0,uniqueEdges,:]
       if 'timeMonthly_avg_normalGMBolusVelocity' in ncid.variables.keys():
-        vel += ncid.variables['timeMonthly_avg_normalGMBolusVelocity'][0,edgesToRead,:]
+        vel += ncid.variables['timeMonthly_avg_normalGMBolusVelocity'][0,uniqueEdges,:]
     else:
       raise KeyError('no appropriate normalVelocity variable found')
     t[i] = ncid.variables['timeMonthly_avg_daysSinceStartOfSim'][:] / 365.
     ncid.close()
-#   Compute transport for each transect
-    for j in range(nTransects):
-      start = int(nTransectStartStop[j])
-      stop = int(nTransectStartStop[j+1])
-      transport[i,j] = (dvEdge[start:stop,np.newaxis]*h[np.newaxis,:]*vel[start:stop,:] \
-          *edgeSigns[j,start:stop,np.newaxis]).sum()*m3ps_to_Sv
+#   Compute transport for each transect and level
+    vel = np.ma.filled(vel, 0.)
+    transportProfile[i,:,:] = transectWeights.dot(vel*h[np.newaxis,:])*m3ps_to_Sv
+  transport = transportProfile.sum(axis=2)
 
 # Define some dictionaries for transect plotting
   obsDict = {'Drake Passage':[120,175],'Tasmania-Ant':[147,167],'Africa-Ant':None,'Antilles Inflow':[-23.1,-13.7], \
@@ -145,13 +159,16 @@ def compute_transport(timeavg, mesh, mask, name='Drake Passage',output='transpor
   ncid=Dataset(output,mode='w',clobber=True, format='NETCDF3_CLASSIC')
   ncid.createDimension('Time',None)
   ncid.createDimension('nTransects',nTransects)
+  ncid.createDimension('nVertLevels',nVertLevels)
   ncid.createDimension('StrLen',64)
   transectNames=ncid.createVariable('TransectNames','c',('nTransects','StrLen'))
   times=ncid.createVariable('Time','f8','Time')
   transportOut=ncid.createVariable('Transport','f8',('Time','nTransects'))
+  transportProfileOut=ncid.createVariable('TransportProfile','f8',('Time','nTransects','nVertLevels'))
 
   times[:] = t
   transportOut[:,:] = transport
+  transportProfileOut[:,:,:] = transportProfile
 
   for i in range(nTransects):
     nLetters = len(transectList[i])